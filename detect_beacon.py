@@ -1,15 +1,530 @@
+import argparse
+import ctypes
+import json
+import math
+import re
+import multiprocessing
+import queue
+import signal
 import socket
 import struct
+import sys
+import threading
 import time
 import os
-from collections import defaultdict
+from array import array
+from collections import OrderedDict, deque
 
 # --- CONFIGURATION ---
 THRESHOLD = 8         # Number of packets to analyze for a pattern
 JITTER_TOLERANCE = 0.4 # Seconds of variance allowed (Lower = more "robotic")
+SCORING = 'range'     # 'range': max-min interval < JITTER_TOLERANCE
+                      # 'cv': stdev/mean interval < CV_TOLERANCE (scales with the interval)
+                      # 'periodic': cv, or arrival phase coherence >= PERIODICITY_MIN
+CV_TOLERANCE = 0.1
+PERIODICITY_MIN = 0.8  # 0..1; random arrivals score about 1/sqrt(THRESHOLD)
 
-# Data store: { (src, dst, port): [timestamps] }
-flow_data = defaultdict(list)
+# What to track: UDP flows, TCP connection starts (SYN without ACK), and
+# DNS queries keyed by the queried base domain (last two labels)
+TRACK_TCP = True
+DNS_PORT = 53
+# Copies of one packet (e.g. seen leaving and entering, or on two interfaces
+# of a router) arrive microseconds apart; count them once
+DUPLICATE_WINDOW = 0.005
+
+# Capture: bytes copied per frame (headers + DNS question) and stats reporting period
+SNAPLEN = 320
+STATS_INTERVAL = 10   # Seconds between packets-per-second reports
+
+# Precompiled header layouts; only the fields we use are decoded
+# IP: version/IHL, flags/fragment offset, protocol, source, destination
+IP_FIELDS = struct.Struct('!B5xHxB2x4s4s')
+# UDP/TCP: source port, destination port
+L4_PORTS = struct.Struct('!HH')
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+PROTO_NAMES = {6: 'tcp', 17: 'udp'}
+# Linux getsockopt(SOL_PACKET, PACKET_STATISTICS): packets, drops (reset on read)
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+TPACKET_STATS = struct.Struct('II')
+ETHERTYPE = struct.Struct('!H')
+ETH_P_IP = 0x0800
+
+# pcap link types we can strip down to the IPv4 header
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+# Live sockets deliver packets starting at the IP header on both platforms
+LIVE_LINKTYPE = LINKTYPE_RAW
+# pcapng block types
+PCAPNG_SHB = b'\x0a\x0d\x0d\x0a'
+PCAPNG_IDB = 1
+PCAPNG_EPB = 6
+
+# Flow table bounds: oldest flows are evicted past MAX_FLOWS or after
+# FLOW_IDLE_TIMEOUT seconds without a packet, so floods cannot exhaust memory
+MAX_FLOWS = 100000
+FLOW_IDLE_TIMEOUT = 300
+
+class Flow:
+    """Streaming interval statistics over the last THRESHOLD packets of one flow.
+
+    Every update is O(1) regardless of window size: the interval ring feeds a
+    sliding Welford mean/variance, and two monotonic deques of ring indices
+    track the window min and max.
+    """
+    __slots__ = ('intervals', 'size', 'seq', 'n', 'mean', 'm2',
+                 'minq', 'maxq', 'count', 'last_seen')
+
+    def __init__(self, packets):
+        self.size = max(2, packets - 1)
+        self.intervals = array('d', bytes(8 * self.size))
+        self.seq = 0          # intervals seen so far; ring slot is seq % size
+        self.n = 0            # intervals currently in the window
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minq = deque()
+        self.maxq = deque()
+        self.count = 0        # packets seen
+        self.last_seen = 0.0
+
+    def add(self, ts):
+        if self.count:
+            self.push_interval(ts - self.last_seen)
+        self.count += 1
+        self.last_seen = ts
+
+    def push_interval(self, x):
+        ring = self.intervals
+        size = self.size
+        i = self.seq
+        slot = i % size
+        if self.n == size:
+            # Remove the interval leaving the window (reverse Welford step)
+            old = ring[slot]
+            n = self.n - 1
+            mean = self.mean - (old - self.mean) / n
+            self.m2 -= (old - self.mean) * (old - mean)
+            self.mean = mean
+            self.n = n
+        ring[slot] = x
+        self.seq = i + 1
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 = max(0.0, self.m2 + delta * (x - self.mean))
+
+        oldest = i - size
+        maxq = self.maxq
+        while maxq and ring[maxq[-1] % size] <= x:
+            maxq.pop()
+        maxq.append(i)
+        if maxq[0] <= oldest:
+            maxq.popleft()
+        minq = self.minq
+        while minq and ring[minq[-1] % size] >= x:
+            minq.pop()
+        minq.append(i)
+        if minq[0] <= oldest:
+            minq.popleft()
+
+    def full(self):
+        return self.n == self.size
+
+    def jitter(self):
+        """Window max - min interval."""
+        size = self.size
+        return self.intervals[self.maxq[0] % size] - self.intervals[self.minq[0] % size]
+
+    def stdev(self):
+        return math.sqrt(self.m2 / self.n) if self.n else 0.0
+
+    def cv(self):
+        """Coefficient of variation (stdev / mean) of the window's intervals."""
+        return self.stdev() / self.mean if self.mean > 0 else float('inf')
+
+    def periodicity(self):
+        """Phase coherence (0..1) of the window's arrivals at the mean interval.
+
+        This is the normalized DFT magnitude of the arrival train at 1/mean.
+        Scheduled beacons stay near 1 even when individual check-ins are
+        jittered (early/late arrivals do not shift later ones), where the
+        max-min rule fails; random traffic scores about 1/sqrt(n).
+        """
+        if self.mean <= 0:
+            return 0.0
+        ring = self.intervals
+        size = self.size
+        step = 2.0 * math.pi / self.mean
+        t = c = s = 0.0
+        for i in range(self.seq - self.n, self.seq):
+            t += ring[i % size]
+            c += math.cos(step * t)
+            s += math.sin(step * t)
+        return math.hypot(c, s) / self.n
+
+def score_flow(flow):
+    """Returns (metric, is_beacon) for the configured SCORING mode, or None if not scored now."""
+    if SCORING == 'periodic':
+        # O(window) check, so run it once per quarter window: O(1) amortized per packet
+        if flow.seq % max(1, flow.size // 4):
+            return None
+        coherence = flow.periodicity()
+        return coherence, coherence >= PERIODICITY_MIN or flow.cv() < CV_TOLERANCE
+    if SCORING == 'cv':
+        value = flow.cv()
+        return value, value < CV_TOLERANCE
+    value = flow.jitter()
+    return value, value < JITTER_TOLERANCE
+
+class FlowTable:
+    """LRU-ordered flow table with a size cap and idle-timeout eviction."""
+
+    def __init__(self, max_flows=MAX_FLOWS, idle_timeout=FLOW_IDLE_TIMEOUT, window=None):
+        self.flows = OrderedDict()
+        self.max_flows = max_flows
+        self.idle_timeout = idle_timeout
+        self.window = window or THRESHOLD
+        self.evicted_idle = 0
+        self.evicted_full = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def touch(self, key, now):
+        """Returns the flow for key (creating it), marked most recently used."""
+        flow = self.flows.get(key)
+        if flow is None:
+            if len(self.flows) >= self.max_flows:
+                self.expire(now)
+                if len(self.flows) >= self.max_flows:
+                    self.flows.popitem(last=False)
+                    self.evicted_full += 1
+            flow = self.flows[key] = Flow(self.window)
+        else:
+            self.flows.move_to_end(key)
+        return flow
+
+    def expire(self, now):
+        """Drops flows idle longer than idle_timeout (they sit at the LRU front)."""
+        cutoff = now - self.idle_timeout
+        flows = self.flows
+        while flows:
+            key = next(iter(flows))
+            if flows[key].last_seen >= cutoff:
+                break
+            del flows[key]
+            self.evicted_idle += 1
+
+    def stats(self):
+        return (f"flows: {len(self.flows)}/{self.max_flows}"
+                f" ({100.0 * len(self.flows) / self.max_flows:.0f}%),"
+                f" evicted {self.evicted_idle} idle / {self.evicted_full} full")
+
+flows = FlowTable()
+
+# Sharded pipeline (--workers N): packed flow key + timestamp records
+# (names past 64 bytes are truncated), packets per batch sent to a shard, the longest a partial batch
+# waits
+SHARD_RECORD = struct.Struct('=B4s4sH64sd')
+SHARD_BATCH = 256
+SHARD_FLUSH = 0.05
+
+# Alerting: a beacon flow alerts once as "new", then at most once per
+# ALERT_COOLDOWN seconds as "ongoing", and "ended" after ALERT_END_AFTER
+# seconds without scoring as a beacon. Events are written by a background
+# thread in batches of up to ALERT_BATCH or every ALERT_FLUSH seconds; if the
+# writer falls ALERT_QUEUE events behind, new events are dropped (and counted)
+# instead of stalling capture.
+ALERT_COOLDOWN = 60
+ALERT_END_AFTER = 180
+ALERT_BATCH = 64
+ALERT_FLUSH = 1.0
+ALERT_QUEUE = 10000
+ALERT_FORMATS = ('text', 'json', 'syslog')
+
+# --- Kernel-side filtering (classic BPF, attached with SO_ATTACH_FILTER) ---
+SO_ATTACH_FILTER = 26
+BPF_INSN = struct.Struct('HBBI')   # struct sock_filter: code, jt, jf, k
+BPF_LD_W_ABS, BPF_LD_H_ABS, BPF_LD_B_ABS = 0x20, 0x28, 0x30
+BPF_LD_H_IND, BPF_LD_B_IND = 0x48, 0x50
+BPF_LDX_MSH = 0xb1                 # X = 4 * (pkt[k] & 0x0f), i.e. the IP header length
+BPF_LD_MEM, BPF_ST = 0x60, 0x02
+BPF_ALU_AND_K, BPF_ALU_MUL_K, BPF_ALU_RSH_K, BPF_ALU_MOD_K = 0x54, 0x24, 0x74, 0x94
+BPF_ALU_XOR_X, BPF_TAX = 0xac, 0x07
+BPF_JEQ_K, BPF_JSET_K = 0x15, 0x45
+BPF_RET_K = 0x06
+
+class BPFCompiler:
+    """Compiles a tcpdump-like filter expression into a classic BPF program.
+
+    Packets start at the IPv4 header (SOCK_DGRAM/ETH_P_IP socket). Grammar:
+      expr    := term ('or' term)*       term := factor ('and' factor)*
+      factor  := 'not' factor | '(' expr ')' | primitive
+      primitive := udp | tcp | icmp | [src|dst] host IP | [src|dst] net CIDR
+                 | [src|dst] port N | from IP | to IP
+    '!', '&&' and '||' are accepted too. Every program also drops traffic the
+    detector never scores (TCP other than connection starts, non-UDP/TCP,
+    non-first fragments) and can keep only 1-in-N flows (by address/port hash).
+    """
+
+    def __init__(self):
+        self.code = []       # [opcode, jt label, jf label, k]
+        self.labels = {}
+        self.next_label = 0
+
+    def label(self):
+        self.next_label += 1
+        return self.next_label
+
+    def place(self, label):
+        self.labels[label] = len(self.code)
+
+    def emit(self, code, k=0, jt=None, jf=None):
+        self.code.append([code, jt, jf, k])
+
+    # -- parsing --
+    def parse(self, text):
+        self.tokens = re.findall(r'\(|\)|&&|\|\||!|[^\s()!]+', text.lower())
+        self.pos = 0
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise ValueError(f"unexpected '{self.tokens[self.pos]}' in filter")
+        return node
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("filter ends unexpectedly")
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek() in ('or', '||'):
+            self.take()
+            node = ('or', node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek() in ('and', '&&'):
+            self.take()
+            node = ('and', node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        token = self.take()
+        if token in ('not', '!'):
+            return ('not', self.parse_not())
+        if token == '(':
+            node = self.parse_or()
+            if self.take() != ')':
+                raise ValueError("missing ')' in filter")
+            return node
+        if token in ('udp', 'tcp', 'icmp'):
+            return ('proto', {'icmp': 1, 'tcp': 6, 'udp': 17}[token])
+        if token in ('from', 'to'):
+            return ('host', 'src' if token == 'from' else 'dst', self.take())
+        direction = None
+        if token in ('src', 'dst'):
+            direction, token = token, self.take()
+        if token == 'host':
+            return ('host', direction, self.take())
+        if token == 'net':
+            return ('net', direction, self.take())
+        if token == 'port':
+            return ('port', direction, int(self.take()))
+        raise ValueError(f"unknown filter primitive '{token}'")
+
+    # -- code generation: jump to t when the node matches, else f --
+    def gen(self, node, t, f):
+        kind = node[0]
+        if kind == 'and':
+            middle = self.label()
+            self.gen(node[1], middle, f)
+            self.place(middle)
+            self.gen(node[2], t, f)
+        elif kind == 'or':
+            middle = self.label()
+            self.gen(node[1], t, middle)
+            self.place(middle)
+            self.gen(node[2], t, f)
+        elif kind == 'not':
+            self.gen(node[1], f, t)
+        elif kind == 'proto':
+            self.emit(BPF_LD_B_ABS, 9)
+            self.emit(BPF_JEQ_K, node[1], t, f)
+        elif kind in ('host', 'net'):
+            if kind == 'host':
+                addr, mask = struct.unpack('!I', socket.inet_aton(node[2]))[0], 0xFFFFFFFF
+            else:
+                net, _, bits = node[2].partition('/')
+                mask = (0xFFFFFFFF << (32 - int(bits or 32))) & 0xFFFFFFFF
+                addr = struct.unpack('!I', socket.inet_aton(net))[0] & mask
+            offsets = {'src': (12,), 'dst': (16,)}.get(node[1], (12, 16))
+            for i, offset in enumerate(offsets):
+                miss = f if i == len(offsets) - 1 else self.label()
+                self.emit(BPF_LD_W_ABS, offset)
+                if mask != 0xFFFFFFFF:
+                    self.emit(BPF_ALU_AND_K, mask)
+                self.emit(BPF_JEQ_K, addr, t, miss)
+                if miss is not f:
+                    self.place(miss)
+        elif kind == 'port':
+            self.load_l4_header(f)
+            offsets = {'src': (0,), 'dst': (2,)}.get(node[1], (0, 2))
+            for i, offset in enumerate(offsets):
+                miss = f if i == len(offsets) - 1 else self.label()
+                self.emit(BPF_LD_H_IND, offset)
+                self.emit(BPF_JEQ_K, node[2], t, miss)
+                if miss is not f:
+                    self.place(miss)
+
+    def load_l4_header(self, f):
+        """UDP/TCP first fragments only; leaves X = IP header length."""
+        is_l4, check_udp, first_frag = self.label(), self.label(), self.label()
+        self.emit(BPF_LD_B_ABS, 9)
+        self.emit(BPF_JEQ_K, 6, is_l4, check_udp)
+        self.place(check_udp)
+        self.emit(BPF_JEQ_K, 17, is_l4, f)
+        self.place(is_l4)
+        self.emit(BPF_LD_H_ABS, 6)
+        self.emit(BPF_JSET_K, 0x1FFF, f, first_frag)
+        self.place(first_frag)
+        self.emit(BPF_LDX_MSH, 0)
+
+    def gen_tracked(self, t, f):
+        """Matches what parse_packet scores: UDP, and TCP SYN without ACK."""
+        check_tcp, is_udp = self.label(), self.label()
+        self.load_l4_header(f)
+        self.emit(BPF_LD_B_ABS, 9)
+        self.emit(BPF_JEQ_K, 17, t, check_tcp)
+        self.place(check_tcp)
+        if not TRACK_TCP:
+            self.emit(BPF_RET_K, 0)
+            return
+        self.emit(BPF_LD_B_IND, 13)
+        self.emit(BPF_ALU_AND_K, TCP_SYN | TCP_ACK)
+        self.emit(BPF_JEQ_K, TCP_SYN, t, f)
+
+    def gen_sample(self, n, t, f):
+        """Keeps 1-in-n flows: hash(src ^ dst ^ dst_port) % n == 0 (X = IP header length)."""
+        self.emit(BPF_LD_W_ABS, 16)
+        self.emit(BPF_TAX)
+        self.emit(BPF_LD_W_ABS, 12)
+        self.emit(BPF_ALU_XOR_X)
+        self.emit(BPF_ST, 0)
+        self.emit(BPF_LDX_MSH, 0)
+        self.emit(BPF_LD_H_IND, 2)
+        self.emit(BPF_TAX)
+        self.emit(BPF_LD_MEM, 0)
+        self.emit(BPF_ALU_XOR_X)
+        self.emit(BPF_ALU_MUL_K, 2654435761)   # Knuth multiplicative mix
+        self.emit(BPF_ALU_RSH_K, 16)
+        self.emit(BPF_ALU_MOD_K, n)
+        self.emit(BPF_JEQ_K, 0, t, f)
+
+    def compile(self, expression=None, sample=1, snaplen=SNAPLEN):
+        accept, reject = self.label(), self.label()
+        tracked = self.label()
+        self.gen_tracked(tracked, reject)
+        self.place(tracked)
+        if expression:
+            matched = self.label()
+            self.gen(self.parse(expression), matched, reject)
+            self.place(matched)
+        if sample > 1:
+            self.gen_sample(sample, accept, reject)
+        self.place(accept)
+        self.emit(BPF_RET_K, snaplen)   # accepted packets are truncated in the kernel too
+        self.place(reject)
+        self.emit(BPF_RET_K, 0)
+
+        program = []
+        for i, (code, jt, jf, k) in enumerate(self.code):
+            offsets = []
+            for target in (jt, jf):
+                offset = 0 if target is None else self.labels[target] - i - 1
+                if not 0 <= offset <= 255:
+                    raise ValueError("filter too long for classic BPF jumps")
+                offsets.append(offset)
+            program.append((code, offsets[0], offsets[1], k & 0xFFFFFFFF))
+        return program
+
+def compile_filter(expression=None, sample=1):
+    return BPFCompiler().compile(expression, sample)
+
+def run_bpf(program, pkt):
+    """Userspace interpreter for the compiled programs (used for --pcap replay)."""
+    a = x = 0
+    mem = [0] * 16
+    pc = 0
+    length = len(pkt)
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        try:
+            if code == BPF_LD_W_ABS:
+                a = struct.unpack_from('!I', pkt, k)[0]
+            elif code == BPF_LD_H_ABS:
+                a = struct.unpack_from('!H', pkt, k)[0]
+            elif code == BPF_LD_B_ABS:
+                a = pkt[k]
+            elif code == BPF_LD_H_IND:
+                a = struct.unpack_from('!H', pkt, x + k)[0]
+            elif code == BPF_LD_B_IND:
+                a = pkt[x + k]
+            elif code == BPF_LDX_MSH:
+                x = 4 * (pkt[k] & 0x0F)
+            elif code == BPF_LD_MEM:
+                a = mem[k]
+            elif code == BPF_ST:
+                mem[k] = a
+            elif code == BPF_TAX:
+                x = a
+            elif code == BPF_ALU_AND_K:
+                a &= k
+            elif code == BPF_ALU_XOR_X:
+                a ^= x
+            elif code == BPF_ALU_MUL_K:
+                a = (a * k) & 0xFFFFFFFF
+            elif code == BPF_ALU_RSH_K:
+                a >>= k
+            elif code == BPF_ALU_MOD_K:
+                a %= k
+            elif code == BPF_JEQ_K:
+                pc += jt if a == k else jf
+            elif code == BPF_JSET_K:
+                pc += jt if a & k else jf
+            elif code == BPF_RET_K:
+                return min(k, length)
+            else:
+                raise ValueError(f"unsupported BPF opcode {code:#x}")
+        except (struct.error, IndexError):
+            return 0   # out-of-bounds loads reject the packet, as in the kernel
+
+def attach_filter(sniffer, program):
+    """Attaches program to the socket and discards anything queued before it."""
+    insns = b''.join(BPF_INSN.pack(*insn) for insn in program)
+    buf = ctypes.create_string_buffer(insns)
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buf))
+    sniffer.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+    sniffer.setblocking(False)
+    try:
+        while True:
+            sniffer.recv(1)
+    except BlockingIOError:
+        pass
+    finally:
+        sniffer.setblocking(True)
 
 def setup_sniffer():
     # Windows Implementation
@@ -31,58 +546,655 @@ def setup_sniffer():
     
     # Linux/Unix Implementation
     else:
-        # AF_PACKET allows us to see all traffic at the driver level on Linux
-        s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(3))
+        # AF_PACKET allows us to see all traffic at the driver level on Linux.
+        # SOCK_DGRAM + ETH_P_IP has the kernel strip whatever link header the
+        # interface uses (Ethernet, VLAN, tun, ...) and deliver IPv4 only.
+        s = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
         return s
 
-def run_detector():
+def read_kernel_stats(sniffer):
+    """Returns (packets, drops) seen by the kernel since the last call, or None."""
+    if os.name == 'nt':
+        return None
+    try:
+        raw = sniffer.getsockopt(SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS.size)
+    except OSError:
+        return None
+    return TPACKET_STATS.unpack(raw)
+
+def report_rate(sniffer, packets, elapsed, table=None):
+    line = f"[*] Rate: {packets / elapsed:.0f} pkt/s over {elapsed:.0f}s"
+    if table is not None:
+        line += f" | {table.stats()}"
+    stats = read_kernel_stats(sniffer)
+    if stats:
+        kernel_packets, drops = stats
+        line += f" | kernel: {kernel_packets} pkts, {drops} dropped"
+    print(line)
+
+def link_offset(linktype, buf, length):
+    """Offset of the IPv4 header for a capture link type, or -1 if not IPv4."""
+    if linktype == LINKTYPE_ETHERNET:
+        if length < 14:
+            return -1
+        ethertype = ETHERTYPE.unpack_from(buf, 12)[0]
+        offset = 14
+        if ethertype in (0x8100, 0x88a8) and length >= 18:  # one VLAN tag
+            ethertype = ETHERTYPE.unpack_from(buf, 16)[0]
+            offset = 18
+        return offset if ethertype == 0x0800 else -1
+    if linktype == LINKTYPE_LINUX_SLL:
+        if length < 16 or ETHERTYPE.unpack_from(buf, 14)[0] != 0x0800:
+            return -1
+        return 16
+    if linktype == LINKTYPE_NULL:
+        return 4
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return 0
+    return -1
+
+def dns_base_domain(buf, offset, length):
+    """Lowercased last two labels of the first DNS question name, or b'' if unparseable."""
+    pos = offset + 12   # skip the DNS header
+    labels = []
+    while pos < length:
+        size = buf[pos]
+        if size == 0:
+            break
+        if size & 0xC0 or pos + 1 + size > length:  # pointer or truncated
+            return b''
+        labels.append(bytes(buf[pos + 1:pos + 1 + size]))
+        pos += 1 + size
+    else:
+        return b''
+    return b'.'.join(labels[-2:]).lower()
+
+def parse_packet(buf, offset, length):
+    """Returns the (proto, src, dst, dst_port, name) flow key for a tracked packet, else None.
+
+    UDP packets are tracked as-is, TCP only on connection starts, and DNS
+    queries also carry their base domain so beacons via a shared resolver
+    (or with random subdomains) still group into one flow.
+    """
+    if length < offset + 20:
+        return None
+
+    # 1. Unpack IP Header (only the fields needed, honoring IHL)
+    ver_ihl, frag, protocol, src_raw, dst_raw = IP_FIELDS.unpack_from(buf, offset)
+    if ver_ihl >> 4 != 4 or frag & 0x1FFF:   # IPv4 only; skip non-first fragments
+        return None
+    l4 = offset + (ver_ihl & 0x0F) * 4
+
+    # 2. Unpack the transport ports
+    if protocol == 17:  # 17 = UDP
+        if length < l4 + 8:
+            return None
+        _src_port, dst_port = L4_PORTS.unpack_from(buf, l4)
+        name = dns_base_domain(buf, l4 + 8, length) if dst_port == DNS_PORT else b''
+        return (17, src_raw, dst_raw, dst_port, name)
+
+    if protocol == 6 and TRACK_TCP:  # 6 = TCP
+        if length < l4 + 14:
+            return None
+        if buf[l4 + 13] & (TCP_SYN | TCP_ACK) != TCP_SYN:
+            return None
+        _src_port, dst_port = L4_PORTS.unpack_from(buf, l4)
+        return (6, src_raw, dst_raw, dst_port, b'')
+
+    return None
+
+def observe(flow_key, now):
+    """Adds one packet to its flow; returns (flow, metric) if the flow scores as a beacon."""
+    flow = flows.touch(flow_key, now)
+    if flow.count and now - flow.last_seen < DUPLICATE_WINDOW:
+        return None
+    flow.add(now)
+    if flow.full():
+        score = score_flow(flow)
+        # If the jitter is low, it's a heartbeat/beacon
+        if score and score[1]:
+            return flow, score[0]
+    return None
+
+def format_metric(metric):
+    if SCORING == 'cv':
+        return f"CV: {metric:.4f}"
+    if SCORING == 'periodic':
+        return f"Periodicity: {metric:.2f}"
+    return f"Jitter: {metric:.4f}s"
+
+def format_flow(flow_key):
+    protocol, src_raw, dst_raw, dst_port, name = flow_key
+    text = f"{PROTO_NAMES.get(protocol, protocol)} {socket.inet_ntoa(src_raw)} -> {socket.inet_ntoa(dst_raw)}:{dst_port}"
+    if name:
+        text += f" ({name.decode('ascii', errors='replace')})"
+    return text
+
+class AlertManager:
+    """Tracks beacon flows through new -> ongoing -> ended and writes their events.
+
+    report() and sweep() run on the capture path and only update a dict and
+    enqueue; formatting and I/O happen on a writer thread. Formats:
+      text    human-readable blocks on stdout (or --alert-file)
+      json    one JSON object per line, CIM-style field names (src, dest,
+              dest_port, transport) for Splunk's _json sourcetype
+      syslog  key=value messages via syslog(3) (ident BEACON_DETECT, LOG_AUTH)
+    """
+
+    def __init__(self, fmt='text', path=None, cooldown=ALERT_COOLDOWN, end_after=ALERT_END_AFTER):
+        self.fmt = fmt
+        self.path = path
+        self.cooldown = cooldown
+        self.end_after = end_after
+        self.active = {}     # flow_key -> [first_seen, last_hit, last_alert, hits since alert, interval, metric]
+        self.dropped = 0
+        self.events = queue.Queue(maxsize=ALERT_QUEUE)
+        self.sensor = socket.gethostname()
+        self.writer = threading.Thread(target=self.write_loop, name="alert-writer", daemon=True)
+        self.writer.start()
+
+    def report(self, flow_key, interval, metric, ts):
+        """Called for every packet that scores as a beacon."""
+        state = self.active.get(flow_key)
+        if state is None:
+            self.active[flow_key] = [ts, ts, ts, 0, interval, metric]
+            self.emit('new', flow_key, ts, ts, 1, interval, metric)
+            return
+        state[1] = ts
+        state[3] += 1
+        state[4] = interval
+        state[5] = metric
+        if ts - state[2] >= self.cooldown:
+            self.emit('ongoing', flow_key, ts, state[0], state[3], interval, metric)
+            state[2] = ts
+            state[3] = 0
+
+    def sweep(self, now):
+        """Ends flows that have not scored as beacons for end_after seconds.
+
+        Slow beacons get longer: at least two of their scoring rounds (periodic
+        scoring only rescores every quarter window). Ended events are stamped
+        with the flow's last beacon activity.
+        """
+        rounds = max(1, (THRESHOLD - 1) // 4) if SCORING == 'periodic' else 1
+        ended = [key for key, state in self.active.items()
+                 if now - state[1] > max(self.end_after, 2 * rounds * state[4])]
+        for flow_key in ended:
+            first_seen, last_hit, _, hits, interval, metric = self.active.pop(flow_key)
+            self.emit('ended', flow_key, last_hit, first_seen, hits, interval, metric)
+
+    def emit(self, state, flow_key, ts, first_seen, hits, interval, metric):
+        try:
+            self.events.put_nowait((state, flow_key, ts, first_seen, hits, interval, metric))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Flushes queued events and stops the writer."""
+        self.events.put(None)
+        self.writer.join()
+        if self.dropped:
+            print(f"[!] {self.dropped} alert events dropped (writer could not keep up)", file=sys.stderr)
+
+    # -- writer thread --
+    def write_loop(self):
+        out = None
+        if self.fmt == 'syslog':
+            import syslog
+            syslog.openlog(ident="BEACON_DETECT", facility=syslog.LOG_AUTH)
+        elif self.path:
+            out = open(self.path, 'a', buffering=1024 * 1024)
+        else:
+            out = sys.stdout
+        running = True
+        while running:
+            batch = []
+            event = self.events.get()
+            deadline = time.monotonic() + ALERT_FLUSH
+            while event is not None:
+                batch.append(event)
+                if len(batch) >= ALERT_BATCH:
+                    break
+                try:
+                    event = self.events.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            running = event is not None
+            if self.fmt == 'syslog':
+                for event in batch:
+                    record = self.record(*event)
+                    priority = syslog.LOG_NOTICE if record['state'] == 'ended' else syslog.LOG_WARNING
+                    syslog.syslog(priority, "BEACON " + " ".join(f"{k}={v}" for k, v in record.items()))
+            else:
+                out.write("".join(self.format(event) for event in batch))
+                out.flush()
+        if out is not None and out is not sys.stdout:
+            out.close()
+
+    def record(self, state, flow_key, ts, first_seen, hits, interval, metric):
+        protocol, src_raw, dst_raw, dst_port, name = flow_key
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ts)) + f".{int(ts % 1 * 1000):03d}Z",
+            'event': 'beacon',
+            'state': state,
+            'sensor': self.sensor,
+            'transport': PROTO_NAMES.get(protocol, str(protocol)),
+            'src': socket.inet_ntoa(src_raw),
+            'dest': socket.inet_ntoa(dst_raw),
+            'dest_port': dst_port,
+        }
+        if name:
+            record['query'] = name.decode('ascii', errors='replace')
+        record.update({
+            'interval': round(interval, 3),
+            'scoring': SCORING,
+            'metric': round(metric, 4),
+            'hits': hits,
+            'first_seen': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(first_seen)),
+            'duration': round(ts - first_seen, 1),
+        })
+        return record
+
+    def format(self, event):
+        if self.fmt == 'json':
+            return json.dumps(self.record(*event)) + "\n"
+        state, flow_key, ts, first_seen, hits, interval, metric = event
+        if state == 'new':
+            head = "[!] BEACON DETECTED"
+        elif state == 'ongoing':
+            head = f"[~] BEACON ONGOING ({hits} hits since last alert, active {ts - first_seen:.0f}s)"
+        else:
+            head = f"[-] BEACON ENDED (active {ts - first_seen:.0f}s)"
+        return (f"\n{head}\n    {format_flow(flow_key)}\n"
+                f"    Interval: {interval:.2f}s | {format_metric(metric)}\n")
+
+def current_config():
+    """Tunables that worker processes must share (spawned children do not see CLI overrides)."""
+    return (THRESHOLD, JITTER_TOLERANCE, SCORING, CV_TOLERANCE, PERIODICITY_MIN,
+            MAX_FLOWS, FLOW_IDLE_TIMEOUT)
+
+def apply_config(config, max_flows=None):
+    """Sets the tunables and a fresh flow table; max_flows overrides the table size (per shard)."""
+    global THRESHOLD, JITTER_TOLERANCE, SCORING, CV_TOLERANCE, PERIODICITY_MIN
+    global MAX_FLOWS, FLOW_IDLE_TIMEOUT, flows
+    (THRESHOLD, JITTER_TOLERANCE, SCORING, CV_TOLERANCE, PERIODICITY_MIN,
+     MAX_FLOWS, FLOW_IDLE_TIMEOUT) = config
+    flows = FlowTable(max_flows=max_flows or MAX_FLOWS, idle_timeout=FLOW_IDLE_TIMEOUT)
+
+def shard_worker(shard, conn, alerts, config, max_flows):
+    """Owns one shard of the flow table; scores batches of (key, ts) records."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    apply_config(config, max_flows)
+    iter_unpack = SHARD_RECORD.iter_unpack
+    next_stats = time.time() + STATS_INTERVAL
+    while True:
+        data = conn.recv_bytes()
+        if not data:
+            break
+        for protocol, src_raw, dst_raw, dst_port, name, ts in iter_unpack(data):
+            flow_key = (protocol, src_raw, dst_raw, dst_port, name.rstrip(b'\x00'))
+            hit = observe(flow_key, ts)
+            if hit:
+                flow, metric = hit
+                alerts.put(("beacon", flow_key, flow.mean, metric, ts))
+        now = time.time()
+        if now >= next_stats:
+            flows.expire(now)
+            alerts.put(("stats", shard, flows.stats()))
+            next_stats = now + STATS_INTERVAL
+    alerts.put(("done", shard))
+
+def alert_aggregator(alerts, workers, config, alert_config):
+    """Feeds alerts from all shards into one AlertManager (flows are per-shard, alerts global)."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    apply_config(config, max_flows=1)
+    manager = AlertManager(*alert_config)
+    done = 0
+    next_sweep = time.time() + STATS_INTERVAL
+    while done < workers:
+        try:
+            msg = alerts.get(timeout=STATS_INTERVAL)
+        except queue.Empty:
+            msg = ("idle",)
+        kind = msg[0]
+        if kind == "done":
+            done += 1
+        elif kind == "stats":
+            print(f"[*] Shard {msg[1]}: {msg[2]}", flush=True)
+        elif kind == "beacon":
+            _, flow_key, interval, metric, ts = msg
+            manager.report(flow_key, interval, metric, ts)
+        now = time.time()
+        if now >= next_sweep:
+            manager.sweep(now)
+            next_sweep = now + STATS_INTERVAL
+    manager.close()
+
+class ShardDispatcher:
+    """Hashes flow keys to worker processes and ships packets in fixed-size batches.
+
+    Each worker gets a one-way pipe; records are packed into a preallocated
+    buffer and sent as raw bytes, so there is no per-packet pickling or IPC.
+    """
+
+    def __init__(self, workers, alert_config):
+        self.n = workers
+        self.alerts = multiprocessing.Queue()
+        config = current_config()
+        shard_flows = max(1, config[5] // workers)  # the --max-flows budget split across shards
+        self.conns = []
+        self.procs = []
+        for shard in range(workers):
+            recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(
+                target=shard_worker,
+                args=(shard, recv_conn, self.alerts, config, shard_flows),
+                daemon=True,
+            )
+            proc.start()
+            recv_conn.close()
+            self.conns.append(send_conn)
+            self.procs.append(proc)
+        self.aggregator = multiprocessing.Process(
+            target=alert_aggregator, args=(self.alerts, workers, config, alert_config), daemon=True
+        )
+        self.aggregator.start()
+        self.buffers = [bytearray(SHARD_RECORD.size * SHARD_BATCH) for _ in range(workers)]
+        self.counts = [0] * workers
+        self.last_flush = time.time()
+
+    def send(self, shard):
+        count = self.counts[shard]
+        if count:
+            self.conns[shard].send_bytes(self.buffers[shard], 0, count * SHARD_RECORD.size)
+            self.counts[shard] = 0
+
+    def submit(self, flow_key, now):
+        shard = hash(flow_key) % self.n
+        count = self.counts[shard]
+        SHARD_RECORD.pack_into(self.buffers[shard], count * SHARD_RECORD.size, *flow_key, now)
+        self.counts[shard] = count + 1
+        if count + 1 >= SHARD_BATCH:
+            self.send(shard)
+
+    def flush_due(self, now):
+        """Send partial batches every SHARD_FLUSH seconds; called from the capture loop."""
+        if now - self.last_flush >= SHARD_FLUSH:
+            # Quiet shards still see their packets promptly
+            for i in range(self.n):
+                self.send(i)
+            self.last_flush = now
+
+    def close(self):
+        for shard in range(self.n):
+            self.send(shard)
+            self.conns[shard].send_bytes(b"")
+        for proc in self.procs:
+            proc.join()
+        self.aggregator.join()
+
+def run_detector(workers=1, bpf_filter=None, sample=1, alert_config=('text',)):
     sniffer = setup_sniffer()
-    print(f"[*] Sniffing for UDP beacons on {os.name}...")
+    print(f"[*] Sniffing for UDP/TCP/DNS beacons on {os.name}...")
+
+    if os.name != 'nt':
+        program = compile_filter(bpf_filter, sample)
+        attach_filter(sniffer, program)
+        print(f"[*] Kernel filter attached ({len(program)} BPF instructions"
+              f"{', 1-in-%d flows' % sample if sample > 1 else ''})")
+    elif bpf_filter or sample > 1:
+        print("[!] --filter/--sample need Linux; capturing unfiltered")
+
+    dispatcher = None
+    alerts = None
+    if workers > 1:
+        dispatcher = ShardDispatcher(workers, alert_config)
+        # Wake up on a quiet link too, so partial batches are not held until the next packet
+        sniffer.settimeout(SHARD_FLUSH)
+        print(f"[*] Sharding flows across {workers} worker processes")
+    else:
+        alerts = AlertManager(*alert_config)
+
+    # One preallocated buffer; recv_into copies at most SNAPLEN bytes per frame
+    # and nothing else is allocated until a packet matches. Windows raw sockets
+    # fail on oversized datagrams instead of truncating, so they get a full buffer.
+    snaplen = 65535 if os.name == 'nt' else SNAPLEN
+    buf = bytearray(snaplen)
+    recv_into = sniffer.recv_into
+    read_kernel_stats(sniffer)  # reset kernel counters
+    ip_offset = link_offset(LIVE_LINKTYPE, buf, snaplen)
+    packets = 0
+    window_start = time.time()
 
     try:
         while True:
-            raw_packet, _ = sniffer.recvfrom(65535)
-            
-            # 1. Unpack IP Header (First 20 bytes)
-            # !BBHHHBBH4s4s is the format for the IP header
-            ip_header = struct.unpack('!BBHHHBBH4s4s', raw_packet[:20])
-            protocol = ip_header[6]
-            
-            if protocol == 17:  # 17 = UDP
-                src_ip = socket.inet_ntoa(ip_header[8])
-                dst_ip = socket.inet_ntoa(ip_header[9])
-                
-                # 2. Unpack UDP Header (Next 8 bytes)
-                # Format: !HHHH (Source Port, Dest Port, Length, Checksum)
-                udp_raw = raw_packet[20:28]
-                udp_header = struct.unpack('!HHHH', udp_raw)
-                dst_port = udp_header[1]
-                
-                # 3. Analyze Timing
-                flow_key = (src_ip, dst_ip, dst_port)
-                now = time.time()
-                flow_data[flow_key].append(now)
-                
-                if len(flow_data[flow_key]) >= THRESHOLD:
-                    timestamps = flow_data[flow_key]
-                    intervals = [timestamps[i] - timestamps[i-1] for i in range(1, len(timestamps))]
-                    
-                    avg_interval = sum(intervals) / len(intervals)
-                    jitter = max(intervals) - min(intervals)
-                    
-                    # If the jitter is low, it's a heartbeat/beacon
-                    if jitter < JITTER_TOLERANCE:
-                        print(f"\n[!] BEACON DETECTED")
-                        print(f"    {src_ip} -> {dst_ip}:{dst_port}")
-                        print(f"    Interval: {avg_interval:.2f}s | Jitter: {jitter:.4f}s")
-                    
-                    # Keep the window sliding
-                    flow_data[flow_key] = timestamps[-THRESHOLD:]
+            try:
+                length = recv_into(buf, snaplen)
+            except socket.timeout:
+                dispatcher.flush_due(time.time())
+                continue
+            packets += 1
+            now = time.time()
+            if dispatcher is not None:
+                dispatcher.flush_due(now)
+            if now - window_start >= STATS_INTERVAL:
+                if dispatcher is None:
+                    flows.expire(now)
+                    alerts.sweep(now)
+                report_rate(sniffer, packets, now - window_start,
+                            flows if dispatcher is None else None)
+                packets = 0
+                window_start = now
+
+            flow_key = parse_packet(buf, ip_offset, length)
+            if flow_key is None:
+                continue
+
+            # 3. Analyze Timing (here, or in the flow's shard process)
+            if dispatcher is not None:
+                dispatcher.submit(flow_key, now)
+                continue
+            hit = observe(flow_key, now)
+            if hit:
+                flow, metric = hit
+                alerts.report(flow_key, flow.mean, metric, now)
 
     except KeyboardInterrupt:
         if os.name == 'nt':
             sniffer.ioctl(socket.SIO_RCVALL, socket.RCVALL_OFF)
+        if dispatcher is not None:
+            dispatcher.close()
+        else:
+            alerts.close()
         print("\nShutting down.")
 
+def read_classic_pcap(f, magic):
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError("not a pcap or pcapng file")
+    resolution = 1e-9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e-6
+    header = f.read(20)
+    if len(header) < 20:
+        raise ValueError("truncated pcap header")
+    linktype = struct.unpack(endian + 'I', header[16:20])[0] & 0xFFFF
+    record = struct.Struct(endian + 'IIII')
+
+    while True:
+        rec = f.read(record.size)
+        if len(rec) < record.size:
+            return
+        sec, frac, incl_len, _orig_len = record.unpack(rec)
+        # Only the headers are needed: read SNAPLEN bytes and skip the payload
+        data = f.read(min(incl_len, SNAPLEN))
+        if incl_len > SNAPLEN:
+            f.seek(incl_len - SNAPLEN, 1)
+        yield sec + frac * resolution, data, linktype
+
+def read_pcapng(f):
+    endian = '<'
+    interfaces = []   # (linktype, timestamp resolution) per interface id
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        if head[:4] == PCAPNG_SHB:
+            bom = f.read(4)
+            endian = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+            block_len = struct.unpack(endian + 'I', head[4:])[0]
+            f.seek(block_len - 12, 1)
+            interfaces = []
+            continue
+
+        block_type, block_len = struct.unpack(endian + 'II', head)
+        if block_len < 12:
+            raise ValueError("corrupt pcapng block")
+        remaining = block_len - 8
+        if block_type == PCAPNG_IDB:
+            body = f.read(remaining)
+            linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+            resolution = 1e-6
+            pos = 8
+            while pos + 4 <= len(body) - 4:
+                code, opt_len = struct.unpack_from(endian + 'HH', body, pos)
+                if code == 0:
+                    break
+                if code == 9 and opt_len >= 1:  # if_tsresol
+                    value = body[pos + 4]
+                    resolution = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+                pos += 4 + ((opt_len + 3) & ~3)
+            interfaces.append((linktype, resolution))
+        elif block_type == PCAPNG_EPB:
+            fixed = f.read(20)
+            iface, ts_high, ts_low, cap_len, _orig_len = struct.unpack(endian + 'IIIII', fixed)
+            data = f.read(min(cap_len, SNAPLEN))
+            f.seek(remaining - 20 - len(data), 1)
+            if iface < len(interfaces):
+                linktype, resolution = interfaces[iface]
+                yield ((ts_high << 32) | ts_low) * resolution, data, linktype
+        else:
+            # Simple packet blocks carry no timestamp; other blocks are metadata
+            f.seek(remaining, 1)
+
+def read_pcap(path):
+    """Yields (timestamp, header bytes, linktype) from a pcap/pcapng file without loading it."""
+    with open(path, 'rb', buffering=1024 * 1024) as f:
+        magic = f.read(4)
+        if magic == PCAPNG_SHB:
+            f.seek(0)
+            yield from read_pcapng(f)
+        else:
+            yield from read_classic_pcap(f, magic)
+
+def replay_pcap(path, bpf_filter=None, sample=1, alerts=None):
+    """Runs a capture file through the same parse/score path as live capture.
+
+    With an AlertManager, alert events are also written, stamped with capture time.
+    """
+    # The live kernel filter, interpreted here so replays see the same packets
+    program = compile_filter(bpf_filter, sample) if bpf_filter or sample > 1 else None
+    print(f"[*] Replaying {path} (threshold={THRESHOLD}, scoring={SCORING})...")
+    start = time.time()
+    packets = 0
+    hits = {}   # flow_key -> [detections, flow, last metric]
+    next_expire = None
+
+    for ts, data, linktype in read_pcap(path):
+        packets += 1
+        if next_expire is None or ts >= next_expire:
+            # Idle eviction runs on capture time, not wall time
+            flows.expire(ts)
+            if alerts is not None:
+                alerts.sweep(ts)
+            next_expire = ts + STATS_INTERVAL
+        length = len(data)
+        offset = link_offset(linktype, data, length)
+        if offset < 0:
+            continue
+        if program and not run_bpf(program, data[offset:]):
+            continue
+        flow_key = parse_packet(data, offset, length)
+        if flow_key is None:
+            continue
+        hit = observe(flow_key, ts)
+        if hit:
+            if alerts is not None:
+                alerts.report(flow_key, hit[0].mean, hit[1], ts)
+            entry = hits.get(flow_key)
+            if entry is None:
+                hits[flow_key] = [1, hit[0], hit[1]]
+            else:
+                entry[0] += 1
+                entry[1], entry[2] = hit
+
+    if alerts is not None:
+        alerts.close()
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"[*] {packets} packets in {elapsed:.2f}s ({packets / elapsed:.0f} pkt/s) | {flows.stats()}")
+    print(f"[*] {len(hits)} flows scored as beacons")
+    for flow_key, (count, flow, metric) in sorted(hits.items(), key=lambda kv: -kv[1][0]):
+        print(f"    {format_flow(flow_key)}"
+              f" | Interval: {flow.mean:.2f}s | {format_metric(metric)} | detections: {count}")
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP/TCP/DNS beacon detector (live raw socket or pcap replay)")
+    parser.add_argument("--pcap", help="Analyze a pcap/pcapng file instead of sniffing live")
+    parser.add_argument("--threshold", type=int, default=THRESHOLD,
+                        help=f"Packets per flow to analyze (default: {THRESHOLD})")
+    parser.add_argument("--jitter", type=float, default=JITTER_TOLERANCE,
+                        help=f"Max-min interval tolerance in seconds (default: {JITTER_TOLERANCE})")
+    parser.add_argument("--scoring", choices=("range", "cv", "periodic"), default=SCORING,
+                        help=f"Beacon scoring rule (default: {SCORING})")
+    parser.add_argument("--cv-tolerance", type=float, default=CV_TOLERANCE,
+                        help=f"Coefficient-of-variation tolerance for --scoring cv (default: {CV_TOLERANCE})")
+    parser.add_argument("--periodicity-min", type=float, default=PERIODICITY_MIN,
+                        help=f"Phase coherence needed by --scoring periodic (default: {PERIODICITY_MIN})")
+    parser.add_argument("--max-flows", type=int, default=MAX_FLOWS,
+                        help=f"Flows tracked before the least recently seen is evicted (default: {MAX_FLOWS}; "
+                             "split across --workers)")
+    parser.add_argument("--idle-timeout", type=float, default=FLOW_IDLE_TIMEOUT,
+                        help=f"Seconds without a packet before a flow is evicted (default: {FLOW_IDLE_TIMEOUT})")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Live mode: shard flows across N worker processes (default: 1, in-process)")
+    parser.add_argument("--filter", default=None,
+                        help="Kernel filter expression, e.g. 'not port 22 and not host 10.0.0.5'")
+    parser.add_argument("--sample", type=int, default=1,
+                        help="Keep every packet of 1-in-N flows, chosen in the kernel (default: 1, all)")
+    parser.add_argument("--alert-format", choices=ALERT_FORMATS, default='text',
+                        help="Alert output: text, json (JSON lines) or syslog (default: text)")
+    parser.add_argument("--alert-file", default=None,
+                        help="Append text/json alerts to this file instead of stdout (with --pcap: write alerts at all)")
+    parser.add_argument("--alert-cooldown", type=float, default=ALERT_COOLDOWN,
+                        help=f"Seconds between repeat alerts for an ongoing beacon (default: {ALERT_COOLDOWN})")
+    parser.add_argument("--alert-end-after", type=float, default=ALERT_END_AFTER,
+                        help=f"Seconds without beacon activity before a flow's alert ends (default: {ALERT_END_AFTER})")
+    args = parser.parse_args()
+
+    if args.alert_format == 'syslog' and os.name == 'nt':
+        parser.error("--alert-format syslog is not available on Windows")
+    alert_config = (args.alert_format, args.alert_file, args.alert_cooldown, args.alert_end_after)
+
+    if args.filter:
+        try:
+            compile_filter(args.filter)
+        except (ValueError, OSError) as exc:
+            parser.error(f"--filter: {exc}")
+
+    if args.max_flows < 1 or args.idle_timeout <= 0:
+        parser.error("--max-flows and --idle-timeout must be positive")
+    apply_config((max(3, args.threshold), args.jitter, args.scoring, args.cv_tolerance,
+                  args.periodicity_min, args.max_flows, args.idle_timeout))
+
+    if args.pcap:
+        # Replays print a per-flow summary; alert events only when asked for
+        alerts = None
+        if args.alert_file or args.alert_format != 'text':
+            alerts = AlertManager(*alert_config)
+        replay_pcap(args.pcap, args.filter, args.sample, alerts)
+    else:
+        run_detector(args.workers, args.filter, args.sample, alert_config)
+
 if __name__ == "__main__":
-    run_detector()
+    main()
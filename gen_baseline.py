@@ -1,44 +1,107 @@
+import argparse
 import os
 import hashlib
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-# Standard name for the baseline database
-DB_NAME = ".integ_db"
+from integ_db import DB_NAME, BaselineWriter, walk_files
 
-def get_sha256(file_path):
-    """Calculates SHA-256 only for regular files; ignores sockets/pipes."""
+# Read buffer for the fallback loop when hashlib.file_digest is unavailable
+READ_BUFFER = 1024 * 1024
+
+def hash_open_file(f):
+    # Plain reads, never mmap: a file truncated mid-hash would raise SIGBUS
+    if hasattr(hashlib, "file_digest"):
+        return hashlib.file_digest(f, "sha256").digest()
+    sha256_hash = hashlib.sha256()
+    buf = bytearray(READ_BUFFER)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        sha256_hash.update(view[:n])
+    return sha256_hash.digest()
+
+def stat_key(st):
+    """The stat fields stored in the baseline: (size, mtime_ns, ctime_ns, inode)."""
+    return (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+def get_entry(file_path):
+    """Returns (raw sha256 digest, stat_key) for a regular file, or None for anything else."""
     try:
         # Check if it's a regular file (not a socket, device, or directory)
         if not os.path.isfile(file_path) or os.path.islink(file_path):
             return None
-            
-        sha256_hash = hashlib.sha256()
+
         with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
-    except (PermissionError, OSError):
+            st = os.fstat(f.fileno())
+            return hash_open_file(f), stat_key(st)
+    except (PermissionError, OSError, ValueError):
         return None
 
-def generate_baseline(directory):
+def get_sha256(file_path):
+    """Calculates SHA-256 only for regular files; ignores sockets/pipes."""
+    entry = get_entry(file_path)
+    return entry[0].hex() if entry else None
+
+def hash_files(paths, workers):
+    """Hashes paths on a thread pool and yields (path, entry) in input order.
+
+    hashlib and file reads release the GIL, so threads keep several disks/cores busy.
+    Only a bounded window of files is in flight, so memory stays flat on huge trees.
+    """
+    if workers <= 1:
+        for path in paths:
+            yield path, get_entry(path)
+        return
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path in paths:
+            window.append((path, pool.submit(get_entry, path)))
+            if len(window) >= workers * 4:
+                path_done, future = window.popleft()
+                yield path_done, future.result()
+        while window:
+            path_done, future = window.popleft()
+            yield path_done, future.result()
+
+def generate_baseline(directory, workers=None):
     directory = os.path.abspath(directory)
     db_path = os.path.join(directory, DB_NAME)
-    
-    with open(db_path, "w") as db:
-        for root, _, files in os.walk(directory):
-            for name in files:
-                if name == DB_NAME: continue
-                
-                filepath = os.path.join(root, name)
-                file_hash = get_sha256(filepath)
-                
-                if file_hash:
-                    db.write(f"{filepath}|{file_hash}\n")
-    
-    print(f"Success: Baseline generated in {db_path}")
+    workers = workers or os.cpu_count() or 1
+
+    count = 0
+    with BaselineWriter(db_path) as db:
+        # walk_files yields paths in the store's sort order, so records stream
+        # straight into the writer without a sort pass.
+        for filepath, entry in hash_files(walk_files(directory), workers):
+            if entry:
+                file_hash, stat_key = entry
+                db.add(filepath, file_hash, stat_key)
+                count += 1
+
+    # Tree digest of the directory: equal digests mean identical trees (e.g. across hosts)
+    top = next((d for d in db.dirs if d[1] == os.fsencode(directory)), None)
+    tree = f", tree digest {top[0].hex()[:16]}" if top else ""
+    print(f"Success: Baseline generated in {db_path} ({count} files, {len(db.dirs)} directories{tree})")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: sudo python3 gen_baseline.py /path/to/monitor")
-    else:
-        generate_baseline(sys.argv[1])
+    parser = argparse.ArgumentParser(
+        description="Generate a SHA-256 baseline for a directory",
+        usage="sudo python3 gen_baseline.py [--workers N] /path/to/monitor",
+    )
+    parser.add_argument("directory")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Hashing threads (default: CPU count, 1 = sequential)",
+    )
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        print(f"Not a directory: {args.directory}")
+        sys.exit(1)
+    generate_baseline(args.directory, args.workers)
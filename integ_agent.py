@@ -0,0 +1,119 @@
+"""Integrity scan agent: streams digests for directories to stdout.
+
+integ_remote.py runs this on each host, either locally or over SSH. Over SSH
+the coordinator sends this module, integ_db.py and gen_baseline.py on stdin
+(`ssh host python3 -`), so nothing has to be installed on the target.
+
+The output is a binary stream of frames, in path_key() order:
+  b"F" FILE_FRAME + path   one regular file
+  b"S" u16 length + path   a directory whose Merkle digest matched (scans only)
+  b"E" u16 length + text   a directory could not be scanned
+  b"Z" u64 file count      end of stream
+
+For scans the coordinator sends the directory digests of the host's stored
+baseline (KNOWN_FRAME records). The agent builds its own tree in a temporary
+baseline and only sends files from directories whose digests differ.
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from gen_baseline import hash_files
+from integ_db import Baseline, BaselineWriter, path_key, pruned_entries, walk_files
+
+# path length, digest, size, mtime_ns, ctime_ns, inode
+FILE_FRAME = struct.Struct("<H32sQqqQ")
+ERROR_FRAME = struct.Struct("<H")
+END_FRAME = struct.Struct("<Q")
+# path length, Merkle digest (followed by the path)
+KNOWN_FRAME = struct.Struct("<H32s")
+
+
+def scan_roots(directories):
+    """Absolute, de-duplicated roots in path_key() order, dropping roots nested in another."""
+    roots = sorted({os.fsencode(os.path.abspath(d)) for d in directories}, key=path_key)
+    kept = []
+    sep = os.fsencode(os.sep)
+    for root in roots:
+        if kept and (root == kept[-1] or root.startswith(kept[-1].rstrip(sep) + sep)):
+            continue
+        kept.append(root)
+    return kept
+
+
+def scan_files(directories, out, workers=None):
+    """Yields (path, digest, stat_key) for every file under directories, writing error frames."""
+    workers = workers or os.cpu_count() or 1
+    for root in scan_roots(directories):
+        if not os.path.isdir(root):
+            message = f"not a directory: {os.fsdecode(root)}".encode("utf-8", "replace")
+            out.write(b"E" + ERROR_FRAME.pack(len(message)) + message)
+            continue
+        for path, entry in hash_files(walk_files(root), workers):
+            if entry is not None:
+                yield (path,) + entry
+
+
+def stream_digests(directories, out, workers=None):
+    """Writes frames for every file under directories; returns the file count."""
+    count = 0
+    for path, digest, stat_key in scan_files(directories, out, workers):
+        out.write(b"F" + FILE_FRAME.pack(len(path), digest, *stat_key) + path)
+        count += 1
+    out.write(b"Z" + END_FRAME.pack(count))
+    out.flush()
+    return count
+
+
+def stream_changes(directories, out, known, workers=None):
+    """Like stream_digests, but directories whose digest matches known[path] go as one b"S" frame."""
+    tmp_dir = tempfile.mkdtemp(prefix="integ_agent.")
+    try:
+        db_path = os.path.join(tmp_dir, "scan.integ_db")
+        with BaselineWriter(db_path) as db:
+            for path, digest, stat_key in scan_files(directories, out, workers):
+                db.add(path, digest, stat_key)
+        with Baseline(db_path) as baseline:
+            for frame in pruned_entries(baseline, known):
+                if frame[0] == "same":
+                    out.write(b"S" + ERROR_FRAME.pack(len(frame[1])) + frame[1])
+                else:
+                    _, path, digest, stat_key = frame
+                    out.write(b"F" + FILE_FRAME.pack(len(path), digest, *stat_key) + path)
+            out.write(b"Z" + END_FRAME.pack(len(baseline)))
+        out.flush()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def parse_known(blob):
+    known = {}
+    pos = 0
+    while pos < len(blob):
+        length, digest = KNOWN_FRAME.unpack_from(blob, pos)
+        pos += KNOWN_FRAME.size
+        known[blob[pos:pos + length]] = digest
+        pos += length
+    return known
+
+
+def main(argv=None, known=None):
+    args = sys.argv[1:] if argv is None else argv
+    workers = None
+    if args[:1] == ["--workers"]:
+        workers, args = int(args[1]), args[2:]
+    if not args:
+        print("usage: integ_agent.py [--workers N] /dir1 /dir2 ...", file=sys.stderr)
+        return 2
+    if known is None:
+        stream_digests(args, sys.stdout.buffer, workers)
+    else:
+        stream_changes(args, sys.stdout.buffer, parse_known(known), workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
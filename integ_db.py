@@ -0,0 +1,462 @@
+"""Baseline store shared by gen_baseline.py and monitor_integ.py.
+
+The .integ_db file is a versioned binary file that is read through mmap:
+
+  header   magic, version, record count, paths offset, records offset,
+           directory count, directories offset
+  paths    raw path bytes, back to back (any bytes except NUL are safe)
+  records  one fixed-size record per file, sorted by path_key():
+           raw SHA-256 digest (32 bytes), size, mtime_ns, ctime_ns, inode,
+           path offset and path length
+  dirs     one fixed-size record per directory holding baselined files, also
+           sorted by path_key(): Merkle digest, path offset and length, index
+           of its first file record, file count, and number of directories
+           below it
+
+A directory's digest is SHA-256 over its children in name order (b"f" or b"d",
+name, NUL, child digest), so two trees match below a directory exactly when
+its digests match. Records are in depth-first order, so every subtree's files
+are one contiguous run of records, and its directories one run of dir records.
+
+Because records are fixed-size and sorted, lookups are a binary search and
+loading a million-file baseline only maps the file instead of parsing it.
+Version 1 files (no directory table) and old text databases
+(path|hash[|size|mtime_ns|ctime_ns|inode]) are still readable.
+"""
+
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+DB_NAME = ".integ_db"
+STATE_NAME = ".integ_state"
+SKIP_NAMES = {os.fsencode(DB_NAME), os.fsencode(STATE_NAME), os.fsencode(DB_NAME + ".tmp")}
+
+MAGIC = b"INTEGDB\x00"
+VERSION = 2
+# magic, version, reserved, record count, paths offset, records offset
+# (+ directory count, directories offset in version 2)
+HEADER_V1 = struct.Struct("<8sH6xQQQ")
+HEADER = struct.Struct("<8sH6xQQQQQ")
+# digest, size, mtime_ns, ctime_ns, inode, path offset, path length
+RECORD = struct.Struct("<32sQqqQQI4x")
+# Merkle digest, path offset, path length, first file index, file count, directories below
+DIR_RECORD = struct.Struct("<32sQI4xQQQ")
+
+SEP = os.fsencode(os.sep)
+
+
+def path_key(path):
+    """Sort key for paths: component-wise order, as produced by walk_files()."""
+    return path.replace(SEP, b"\x00")
+
+
+def is_within(path, directory):
+    """True if path is directory or below it."""
+    if path == directory:
+        return True
+    return path.startswith(directory if directory.endswith(SEP) else directory + SEP)
+
+
+def display_path(path):
+    """Printable form of a bytes path (undecodable bytes are escaped)."""
+    return path.decode("utf-8", errors="backslashreplace")
+
+
+def walk_files(top):
+    """Yields file paths (bytes) under top in path_key() order.
+
+    Every directory's entries are sorted by name and visited depth-first, so
+    the stream can be merged against a baseline without sorting it again.
+    Symlinks are yielded but never followed.
+    """
+    top = os.fsencode(top)
+    try:
+        with os.scandir(top) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            continue
+        if is_dir:
+            yield from walk_files(entry.path)
+        elif entry.name not in SKIP_NAMES:
+            yield entry.path
+
+
+class BaselineWriter:
+    """Streams sorted entries into a new .integ_db, replacing it atomically on close.
+
+    The directory tree is built on the fly: entries arrive depth-first, so a
+    stack of open directories is enough, and a directory's digest is final
+    as soon as the first path outside it arrives.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.tmp_path = db_path + ".tmp"
+        self.f = open(self.tmp_path, "wb")
+        self.f.write(b"\x00" * HEADER.size)
+        self.records = tempfile.TemporaryFile()
+        self.count = 0
+        self.paths_size = 0
+        self.last_key = None
+        self.dirs = []    # [digest, path, first file, file count, dirs below], depth-first
+        self.open_dirs = []   # (index into dirs, hasher) from the root down
+
+    def add(self, path, digest, stat_key):
+        key = path_key(path)
+        if self.last_key is not None and key <= self.last_key:
+            raise ValueError(f"baseline entries out of order: {display_path(path)}")
+        self.last_key = key
+        self.enter_dir(os.path.dirname(path))
+        self.open_dirs[-1][1].update(b"f" + os.path.basename(path) + b"\x00" + digest)
+        self.f.write(path)
+        self.records.write(RECORD.pack(digest, *stat_key, self.paths_size, len(path)))
+        self.paths_size += len(path)
+        self.count += 1
+
+    def enter_dir(self, directory):
+        """Closes open directories that do not contain directory, then opens it and its parents."""
+        while self.open_dirs and not is_within(directory, self.dirs[self.open_dirs[-1][0]][1]):
+            self.close_dir()
+        chain = []
+        while not self.open_dirs or self.dirs[self.open_dirs[-1][0]][1] != directory:
+            chain.append(directory)
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        for directory in reversed(chain):
+            self.open_dirs.append((len(self.dirs), hashlib.sha256()))
+            self.dirs.append([None, directory, self.count, 0, 0])
+
+    def close_dir(self):
+        index, hasher = self.open_dirs.pop()
+        entry = self.dirs[index]
+        entry[0] = hasher.digest()
+        entry[3] = self.count - entry[2]
+        entry[4] = len(self.dirs) - index - 1
+        if self.open_dirs:
+            self.open_dirs[-1][1].update(b"d" + os.path.basename(entry[1]) + b"\x00" + entry[0])
+
+    def close(self):
+        while self.open_dirs:
+            self.close_dir()
+        # Directory paths go after the file paths in the same blob
+        dir_offsets = []
+        for entry in self.dirs:
+            dir_offsets.append(self.paths_size)
+            self.f.write(entry[1])
+            self.paths_size += len(entry[1])
+        records_offset = HEADER.size + self.paths_size
+        self.records.seek(0)
+        shutil.copyfileobj(self.records, self.f)
+        self.records.close()
+        dirs_offset = records_offset + self.count * RECORD.size
+        for (digest, path, first, count, below), offset in zip(self.dirs, dir_offsets):
+            self.f.write(DIR_RECORD.pack(digest, offset, len(path), first, count, below))
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, self.count, HEADER.size, records_offset,
+                                 len(self.dirs), dirs_offset))
+        self.f.close()
+        os.replace(self.tmp_path, self.db_path)
+
+    def abort(self):
+        self.records.close()
+        self.f.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Baseline:
+    """Read-only, memory-mapped view of a binary .integ_db."""
+
+    def __init__(self, db_path):
+        with open(db_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER_V1.size:
+            self.mm.close()
+            raise ValueError(f"{db_path}: truncated baseline")
+        magic, version = struct.unpack_from("<8sH", self.mm, 0)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f"{db_path}: not a binary baseline")
+        if version == 1:
+            _, _, count, paths_offset, records_offset = HEADER_V1.unpack_from(self.mm, 0)
+            dir_count = dirs_offset = 0
+        elif version == VERSION and len(self.mm) >= HEADER.size:
+            _, _, count, paths_offset, records_offset, dir_count, dirs_offset = HEADER.unpack_from(self.mm, 0)
+        else:
+            self.mm.close()
+            raise ValueError(f"{db_path}: unsupported baseline version {version}")
+        if (records_offset + count * RECORD.size > len(self.mm)
+                or dirs_offset + dir_count * DIR_RECORD.size > len(self.mm)):
+            self.mm.close()
+            raise ValueError(f"{db_path}: truncated baseline")
+        self.count = count
+        self.paths_offset = paths_offset
+        self.records_offset = records_offset
+        self.dir_count = dir_count
+        self.dirs_offset = dirs_offset
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        """Returns (path, digest, stat_key) for record i."""
+        digest, size, mtime_ns, ctime_ns, ino, offset, length = RECORD.unpack_from(
+            self.mm, self.records_offset + i * RECORD.size
+        )
+        start = self.paths_offset + offset
+        return self.mm[start:start + length], digest, (size, mtime_ns, ctime_ns, ino)
+
+    def path_at(self, i):
+        offset, length = struct.unpack_from(
+            "<QI", self.mm, self.records_offset + i * RECORD.size + 64
+        )
+        start = self.paths_offset + offset
+        return self.mm[start:start + length]
+
+    def get(self, path):
+        """Returns (digest, stat_key) for path, or None (binary search)."""
+        key = path_key(path)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if path_key(self.path_at(mid)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.path_at(lo) == path:
+            _, digest, stat_key = self.entry(lo)
+            return digest, stat_key
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+    # -- directory tree (empty for version 1 files) --
+    def dir_entry(self, i):
+        """Returns (path, digest, first file index, file count, dirs below) for directory i."""
+        digest, offset, length, first, count, below = DIR_RECORD.unpack_from(
+            self.mm, self.dirs_offset + i * DIR_RECORD.size
+        )
+        start = self.paths_offset + offset
+        return self.mm[start:start + length], digest, first, count, below
+
+    def dir_index(self, path):
+        """Index of directory path in the tree, or None (binary search)."""
+        key = path_key(path)
+        lo, hi = 0, self.dir_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if path_key(self.dir_entry(mid)[0]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.dir_count and self.dir_entry(lo)[0] == path:
+            return lo
+        return None
+
+    def roots(self):
+        """Indexes of the top-level directories (normally just the filesystem root)."""
+        i = 0
+        while i < self.dir_count:
+            yield i
+            i += self.dir_entry(i)[4] + 1
+
+    def children(self, i):
+        """Yields (name, is_dir, index) for directory i's children in name order.
+
+        Direct files are the records between the subdirectories' file runs.
+        """
+        _, _, first, count, below = self.dir_entry(i)
+        pos = first
+        j = i + 1
+        while j <= i + below:
+            sub_path, _, sub_first, sub_count, sub_below = self.dir_entry(j)
+            for k in range(pos, sub_first):
+                yield os.path.basename(self.path_at(k)), False, k
+            yield os.path.basename(sub_path), True, j
+            pos = sub_first + sub_count
+            j += sub_below + 1
+        for k in range(pos, first + count):
+            yield os.path.basename(self.path_at(k)), False, k
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class LegacyBaseline:
+    """Read-only view of an old text path|hash[|size|mtime_ns|ctime_ns|inode] database."""
+
+    def __init__(self, db_path):
+        self.entries = {}
+        with open(db_path, "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\n")
+                if b"|" not in line:
+                    continue
+                fields = line.rsplit(b"|", 5)
+                if len(fields) == 6 and all(x.isdigit() for x in fields[2:]):
+                    path, f_hash = fields[0], fields[1]
+                    stat_key = tuple(int(x) for x in fields[2:])
+                else:
+                    path, f_hash = line.rsplit(b"|", 1)
+                    stat_key = None
+                try:
+                    self.entries[path] = (bytes.fromhex(f_hash.decode("ascii")), stat_key)
+                except ValueError:
+                    continue
+        self.order = sorted(self.entries, key=path_key)
+
+    def __len__(self):
+        return len(self.order)
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def __iter__(self):
+        for path in self.order:
+            digest, stat_key = self.entries[path]
+            yield path, digest, stat_key
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_baseline(db_path):
+    """Opens a binary or legacy text baseline with the same read interface."""
+    with open(db_path, "rb") as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return Baseline(db_path)
+    return LegacyBaseline(db_path)
+
+
+def diff_trees(old, new):
+    """Yields (kind, path) for files that are "missing", "modified" or "new" in new vs old.
+
+    With directory trees on both sides, only directories whose digests differ
+    are opened, so the cost follows the size of the change rather than the
+    tree. Otherwise both baselines are merge-joined in full.
+    """
+    if not (getattr(old, "dir_count", 0) and getattr(new, "dir_count", 0)):
+        yield from diff_streams(iter(old), iter(new))
+        return
+
+    def subtree(baseline, i):
+        _, _, first, count, _ = baseline.dir_entry(i)
+        return (baseline.path_at(k) for k in range(first, first + count))
+
+    def diff_dir(i, j):
+        if old.dir_entry(i)[1] == new.dir_entry(j)[1]:
+            return
+        yield from diff_children(list(old.children(i)), list(new.children(j)))
+
+    def diff_children(a, b):
+        x = y = 0
+        while x < len(a) or y < len(b):
+            if y == len(b) or (x < len(a) and a[x][0] < b[y][0]):
+                kind_old, kind_new = a[x], None
+                x += 1
+            elif x == len(a) or b[y][0] < a[x][0]:
+                kind_old, kind_new = None, b[y]
+                y += 1
+            else:
+                kind_old, kind_new = a[x], b[y]
+                x += 1
+                y += 1
+            if kind_old and kind_new and kind_old[1] == kind_new[1]:
+                if kind_old[1]:
+                    yield from diff_dir(kind_old[2], kind_new[2])
+                elif old.entry(kind_old[2])[1] != new.entry(kind_new[2])[1]:
+                    yield "modified", new.path_at(kind_new[2])
+                continue
+            if kind_old:
+                paths = subtree(old, kind_old[2]) if kind_old[1] else [old.path_at(kind_old[2])]
+                for path in paths:
+                    yield "missing", path
+            if kind_new:
+                paths = subtree(new, kind_new[2]) if kind_new[1] else [new.path_at(kind_new[2])]
+                for path in paths:
+                    yield "new", path
+
+    old_roots = [(old.dir_entry(i)[0], True, i) for i in old.roots()]
+    new_roots = [(new.dir_entry(j)[0], True, j) for j in new.roots()]
+    yield from diff_children(old_roots, new_roots)
+
+
+def diff_streams(old_entries, new_entries):
+    """Merge-joins two sorted (path, digest, ...) streams; yields (kind, path)."""
+    old_entry = next(old_entries, None)
+    new_entry = next(new_entries, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (old_entry is not None and path_key(old_entry[0]) < path_key(new_entry[0])):
+            yield "missing", old_entry[0]
+            old_entry = next(old_entries, None)
+        elif old_entry is None or path_key(new_entry[0]) < path_key(old_entry[0]):
+            yield "new", new_entry[0]
+            new_entry = next(new_entries, None)
+        else:
+            if old_entry[1] != new_entry[1]:
+                yield "modified", new_entry[0]
+            old_entry = next(old_entries, None)
+            new_entry = next(new_entries, None)
+
+
+def pruned_entries(baseline, known):
+    """Yields ("file", path, digest, stat_key) and ("same", directory) in path_key() order.
+
+    known maps directory paths to digests from another baseline; any directory
+    whose digest matches is reported once as "same" instead of file by file.
+    """
+    if not getattr(baseline, "dir_count", 0):
+        for entry in baseline:
+            yield ("file",) + tuple(entry)
+        return
+
+    def walk(i):
+        path, digest = baseline.dir_entry(i)[:2]
+        if known.get(path) == digest:
+            yield "same", path
+            return
+        for _, is_dir, index in baseline.children(i):
+            if is_dir:
+                yield from walk(index)
+            else:
+                yield ("file",) + baseline.entry(index)
+
+    for root in baseline.roots():
+        yield from walk(root)
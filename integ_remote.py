@@ -0,0 +1,371 @@
+"""Fleet integrity scans: run integ_agent on many hosts at once and diff centrally.
+
+  python3 integ_remote.py baseline            # fetch and store a baseline per host
+  python3 integ_remote.py scan                # compare every host against its baseline
+  python3 integ_remote.py scan --hosts splunk --json
+
+Hosts come from config/integrity_hosts.json. For each host the coordinator
+starts `ssh <target> python3 -` and sends the agent code on stdin. A host
+with "local": true runs the agent as a local subprocess instead. Agents hash
+on their own host and stream compact binary digest records back.
+
+Baselines live centrally in <store>/<host>.integ_db, in the same format as
+gen_baseline.py. A scan sends the agent the baseline's directory digests.
+The agent then returns only files from subtrees that differ, and the
+coordinator merge-joins them against the baseline as they arrive. Up to
+--concurrency hosts run at once, so a sweep takes about as long as the
+slowest host.
+
+  python3 integ_remote.py diff --hosts web1,web2   # compare two stored baselines
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shlex
+import signal
+import sys
+import time
+
+from integ_agent import END_FRAME, ERROR_FRAME, FILE_FRAME, KNOWN_FRAME
+from integ_db import BaselineWriter, diff_trees, display_path, open_baseline, path_key
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG = os.path.join(HERE, "config", "integrity_hosts.json")
+DEFAULT_STORE = os.path.join(HERE, "artifacts", "integrity")
+DEFAULT_CONCURRENCY = 4
+DEFAULT_TIMEOUT = 900
+SSH_CONNECT_TIMEOUT = 10
+# Modules shipped to remote hosts, in import order
+AGENT_MODULES = ("integ_db", "gen_baseline", "integ_agent")
+AGENT_BOOTSTRAP = """\
+import base64, sys, types
+for name, source in {sources!r}:
+    module = types.ModuleType(name)
+    sys.modules[name] = module
+    exec(compile(source, name + ".py", "exec"), module.__dict__)
+known = {known!r}
+sys.exit(sys.modules["integ_agent"].main(known=base64.b64decode(known) if known is not None else None))
+"""
+# Changes listed per host in the text report (all of them go into --json)
+MAX_LISTED = 50
+
+
+def load_config(path):
+    with open(path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def agent_sources():
+    sources = []
+    for name in AGENT_MODULES:
+        with open(os.path.join(HERE, name + ".py"), "r", encoding="utf-8") as handle:
+            sources.append((name, handle.read()))
+    return sources
+
+
+def agent_bundle(sources, baseline=None):
+    """Agent program for stdin; with a baseline, its directory digests ride along."""
+    known = None
+    if baseline is not None:
+        blob = bytearray()
+        for i in range(getattr(baseline, "dir_count", 0)):
+            path, digest = baseline.dir_entry(i)[:2]
+            blob += KNOWN_FRAME.pack(len(path), digest) + path
+        known = base64.b64encode(bytes(blob)).decode("ascii")
+    return AGENT_BOOTSTRAP.format(sources=sources, known=known).encode("utf-8")
+
+
+def agent_command(host):
+    args = [str(d) for d in host["directories"]]
+    if host.get("workers"):
+        args = ["--workers", str(host["workers"])] + args
+    if host.get("local"):
+        return [sys.executable, "-"] + args
+    python = host.get("python", "python3")
+    return [
+        "ssh", "-T",
+        "-o", "BatchMode=yes",
+        "-o", f"ConnectTimeout={SSH_CONNECT_TIMEOUT}",
+        host["ssh"],
+        f"{python} - {shlex.join(args)}",
+    ]
+
+
+async def read_frames(stdout):
+    """Yields ("file", path, digest, stat_key), ("same", directory), ("error", text), then ("end", count)."""
+    while True:
+        kind = await stdout.readexactly(1)
+        if kind == b"F":
+            length, digest, *stat_key = FILE_FRAME.unpack(await stdout.readexactly(FILE_FRAME.size))
+            yield "file", await stdout.readexactly(length), digest, tuple(stat_key)
+        elif kind == b"E":
+            (length,) = ERROR_FRAME.unpack(await stdout.readexactly(ERROR_FRAME.size))
+            yield "error", (await stdout.readexactly(length)).decode("utf-8", "replace")
+        elif kind == b"S":
+            (length,) = ERROR_FRAME.unpack(await stdout.readexactly(ERROR_FRAME.size))
+            yield "same", await stdout.readexactly(length)
+        elif kind == b"Z":
+            (count,) = END_FRAME.unpack(await stdout.readexactly(END_FRAME.size))
+            yield "end", count
+            return
+        else:
+            raise ValueError(f"unexpected agent output {kind!r}")
+
+
+class StreamDiff:
+    """Merge-joins sorted agent frames against a sorted binary baseline (as monitor_integ does).
+
+    A "same" directory matches its whole run of baseline records at once.
+    """
+
+    def __init__(self, baseline):
+        self.baseline = baseline
+        self.pos = 0
+        self.changes = []
+
+    def skip_to(self, end):
+        while self.pos < end:
+            self.changes.append(("missing", self.baseline.path_at(self.pos)))
+            self.pos += 1
+
+    def add(self, path, digest):
+        key = path_key(path)
+        baseline = self.baseline
+        while self.pos < len(baseline) and path_key(baseline.path_at(self.pos)) < key:
+            self.changes.append(("missing", baseline.path_at(self.pos)))
+            self.pos += 1
+        if self.pos < len(baseline) and baseline.path_at(self.pos) == path:
+            if baseline.entry(self.pos)[1] != digest:
+                self.changes.append(("modified", path))
+            self.pos += 1
+        else:
+            self.changes.append(("new", path))
+
+    def same(self, directory):
+        index = self.baseline.dir_index(directory)
+        if index is None:
+            raise ValueError(f"agent matched unknown directory {display_path(directory)}")
+        _, _, first, count, _ = self.baseline.dir_entry(index)
+        self.skip_to(first)
+        self.pos = max(self.pos, first + count)
+
+    def finish(self):
+        self.skip_to(len(self.baseline))
+        return self.changes
+
+
+async def run_host(host, mode, store, sources):
+    """Runs the agent on one host; returns its result dict (never raises)."""
+    name = host["name"]
+    db_path = os.path.join(store, f"{name}.integ_db")
+    result = {"host": name, "status": "failed", "files": 0, "sent": 0, "seconds": 0.0,
+              "errors": [], "changes": []}
+    start = time.monotonic()
+    sink = diff = baseline = proc = None
+    try:
+        if mode == "scan":
+            if not os.path.exists(db_path):
+                raise RuntimeError(f"no baseline in {db_path}; run `integ_remote.py baseline` first")
+            baseline = open_baseline(db_path)
+            if not hasattr(baseline, "dir_entry"):
+                raise RuntimeError(f"{db_path} is a text baseline; run `integ_remote.py baseline` again")
+            diff = StreamDiff(baseline)
+            bundle = agent_bundle(sources, baseline)
+        else:
+            os.makedirs(store, exist_ok=True)
+            sink = BaselineWriter(db_path)
+            bundle = agent_bundle(sources)
+
+        proc = await asyncio.create_subprocess_exec(
+            *agent_command(host),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        stderr_task = asyncio.ensure_future(proc.stderr.read())
+        try:
+            proc.stdin.write(bundle)
+            await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # ssh failed before reading the agent; its stderr says why
+
+        finished = False
+        try:
+            async for frame in read_frames(proc.stdout):
+                if frame[0] == "file":
+                    _, path, digest, stat_key = frame
+                    result["sent"] += 1
+                    if diff is not None:
+                        diff.add(path, digest)
+                    else:
+                        sink.add(path, digest, stat_key)
+                elif frame[0] == "same" and diff is not None:
+                    diff.same(frame[1])
+                elif frame[0] == "error":
+                    result["errors"].append(frame[1])
+                else:
+                    result["files"] = frame[1]
+                    finished = True
+        except asyncio.IncompleteReadError:
+            pass
+        returncode = await proc.wait()
+        stderr = (await stderr_task).decode("utf-8", "replace").strip()
+        if not finished:
+            detail = stderr.splitlines()[-1] if stderr else f"agent exited with status {returncode}"
+            raise RuntimeError(detail)
+
+        if diff is not None:
+            result["changes"] = [{"change": kind, "path": display_path(path)} for kind, path in diff.finish()]
+            # Errors mean whole directories went unscanned, so the diff is incomplete
+            if result["errors"]:
+                result["status"] = "partial"
+            else:
+                result["status"] = "changed" if result["changes"] else "clean"
+        else:
+            if result["errors"]:
+                raise RuntimeError("baseline not stored: some directories could not be scanned")
+            sink.close()
+            sink = None
+            result["status"] = "baselined"
+    except asyncio.CancelledError:
+        result["errors"].append("timed out")
+        raise
+    except (OSError, ValueError, RuntimeError) as exc:
+        result["errors"].append(str(exc))
+    finally:
+        if proc is not None and proc.returncode is None:
+            # The whole session, so nothing the agent started keeps its pipes open
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            await proc.wait()
+        if sink is not None:
+            sink.abort()
+        if baseline is not None:
+            baseline.close()
+        result["seconds"] = round(time.monotonic() - start, 2)
+    return result
+
+
+async def run_fleet(hosts, mode, store, concurrency, timeout):
+    sources = agent_sources()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def bounded(host):
+        async with limit:
+            task = asyncio.ensure_future(run_host(host, mode, store, sources))
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), timeout)
+            except asyncio.TimeoutError:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return {"host": host["name"], "status": "failed", "files": 0, "sent": 0,
+                        "seconds": float(timeout), "errors": [f"timed out after {timeout}s"], "changes": []}
+
+    return await asyncio.gather(*(bounded(host) for host in hosts))
+
+
+def print_report(results, mode, elapsed):
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    summary = ", ".join(f"{n} {status}" for status, n in sorted(counts.items()))
+    print(f"=== Integrity {mode}: {len(results)} hosts, {summary} ({elapsed:.1f}s) ===")
+    marks = {"modified": "M", "new": "+", "missing": "-"}
+    for result in results:
+        line = f"[{result['host']}] {result['status'].upper()} ({result['files']} files"
+        if mode == "scan" and result["status"] != "failed":
+            line += f", {result['sent']} sent"
+        line += f", {result['seconds']}s)"
+        if result["changes"]:
+            by_kind = {}
+            for change in result["changes"]:
+                by_kind[change["change"]] = by_kind.get(change["change"], 0) + 1
+            line += ": " + ", ".join(f"{n} {kind}" for kind, n in sorted(by_kind.items()))
+        print(line)
+        for error in result["errors"]:
+            print(f"  ! {error}")
+        for change in result["changes"][:MAX_LISTED]:
+            print(f"  {marks[change['change']]} {change['path']}")
+        if len(result["changes"]) > MAX_LISTED:
+            print(f"  ... {len(result['changes']) - MAX_LISTED} more (use --json for all)")
+
+
+def diff_hosts(store, old_name, new_name):
+    """Compares two stored host baselines by Merkle descent; returns a result dict."""
+    start = time.monotonic()
+    result = {"host": f"{old_name} -> {new_name}", "status": "failed", "files": 0, "sent": 0,
+              "seconds": 0.0, "errors": [], "changes": []}
+    try:
+        with open_baseline(os.path.join(store, f"{old_name}.integ_db")) as old, \
+                open_baseline(os.path.join(store, f"{new_name}.integ_db")) as new:
+            result["files"] = len(new)
+            result["changes"] = [{"change": kind, "path": display_path(path)}
+                                 for kind, path in diff_trees(old, new)]
+        result["status"] = "changed" if result["changes"] else "clean"
+    except (OSError, ValueError) as exc:
+        result["errors"].append(str(exc))
+    result["seconds"] = round(time.monotonic() - start, 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run integrity baselines/scans on many hosts in parallel")
+    parser.add_argument("mode", choices=("baseline", "scan", "diff"),
+                        help="diff compares the stored baselines of exactly two --hosts")
+    parser.add_argument("--config", default=DEFAULT_CONFIG, help="Host inventory JSON")
+    parser.add_argument("--hosts", default=None, help="Comma-separated host names (default: all enabled)")
+    parser.add_argument("--store", default=None, help="Directory for per-host baselines")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help=f"Hosts scanned at once (default: config or {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--timeout", type=int, default=None,
+                        help=f"Per-host timeout in seconds (default: config or {DEFAULT_TIMEOUT})")
+    parser.add_argument("--json", action="store_true", help="Print the consolidated result as JSON")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    hosts = [h for h in config.get("hosts", []) if h.get("enabled", True)]
+    if args.hosts:
+        wanted = set(args.hosts.split(","))
+        hosts = [h for h in config.get("hosts", []) if h["name"] in wanted]
+        unknown = wanted - {h["name"] for h in hosts}
+        if unknown:
+            parser.error(f"unknown hosts: {', '.join(sorted(unknown))}")
+    if not hosts:
+        parser.error("no hosts selected")
+    store = args.store or config.get("store") or DEFAULT_STORE
+    if not os.path.isabs(store):
+        store = os.path.join(HERE, store)
+    concurrency = max(1, args.concurrency or config.get("concurrency", DEFAULT_CONCURRENCY))
+    timeout = args.timeout or config.get("timeout_seconds", DEFAULT_TIMEOUT)
+
+    start = time.monotonic()
+    if args.mode == "diff":
+        names = args.hosts.split(",") if args.hosts else []
+        if len(names) != 2:
+            parser.error("diff needs --hosts OLD,NEW")
+        results = [diff_hosts(store, *names)]
+    else:
+        results = asyncio.run(run_fleet(hosts, args.mode, store, concurrency, timeout))
+    elapsed = time.monotonic() - start
+    if args.json:
+        print(json.dumps({"mode": args.mode, "seconds": round(elapsed, 2), "hosts": results}, indent=2))
+    else:
+        print_report(results, args.mode, elapsed)
+
+    if any(r["status"] in ("failed", "partial") for r in results):
+        return 2
+    return 1 if any(r["status"] == "changed" for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,65 +1,409 @@
+import argparse
+import ctypes
+import ctypes.util
+import errno
 import os
-import hashlib
-import sys
+import select
+import stat
+import struct
 import syslog
+import time
 
-DB_NAME = ".integ_db"
+from gen_baseline import get_entry, stat_key
+from integ_db import DB_NAME, STATE_NAME, diff_trees, display_path, open_baseline, path_key, walk_files
 
-def get_sha256(file_path):
-    if not os.path.isfile(file_path) or os.path.islink(file_path):
-        return None
+# In --fast mode, still re-hash everything at least this often (seconds), to
+# catch changes made with timestamps reset to their old values.
+DEFAULT_FULL_INTERVAL = 3600
+
+def alert(kind, path):
+    if kind == "missing":
+        syslog.syslog(syslog.LOG_CRIT, f"ALERT: Missing file detected: {display_path(path)}")
+    elif kind == "modified":
+        syslog.syslog(syslog.LOG_CRIT, f"ALERT: File modified (hash mismatch): {display_path(path)}")
+    else:
+        syslog.syslog(syslog.LOG_WARNING, f"ALERT: New file detected: {display_path(path)}")
+
+def last_full_scan(state_path):
+    try:
+        with open(state_path, "r") as f:
+            return float(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0.0
+
+def record_full_scan(state_path):
     try:
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
-    except: return None
-
-def monitor(directories):
+        with open(state_path, "w") as f:
+            f.write(f"{time.time():.0f}\n")
+    except OSError:
+        pass
+
+def compare_stream(baseline, target_dir, full):
+    """Merge-joins the sorted walk against the sorted baseline, alerting immediately.
+
+    Returns (files hashed, files trusted by stat) for the summary line.
+    """
+    hashed = reused = 0
+    base_iter = iter(baseline)
+    base = next(base_iter, None)
+
+    for path in walk_files(target_dir):
+        key = path_key(path)
+        # Baseline entries sorting before this path were not found on disk
+        while base is not None and path_key(base[0]) < key:
+            alert("missing", base[0])
+            base = next(base_iter, None)
+
+        old = None
+        if base is not None and base[0] == path:
+            old = base
+            base = next(base_iter, None)
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            if old: alert("missing", path)
+            continue
+
+        if not full and old and old[2] == stat_key(st):
+            reused += 1
+            continue
+
+        entry = get_entry(path)
+        hashed += 1
+        if entry is None:
+            if old: alert("missing", path)
+        elif old is None:
+            alert("new", path)
+        elif old[1] != entry[0]:
+            alert("modified", path)
+
+    while base is not None:
+        alert("missing", base[0])
+        base = next(base_iter, None)
+    return hashed, reused
+
+def monitor(directories, fast=False, full_interval=DEFAULT_FULL_INTERVAL):
     # Initialize Syslog
     syslog.openlog(ident="FILE_INTEGRITY", facility=syslog.LOG_AUTH)
 
     for target_dir in directories:
         target_dir = os.path.abspath(target_dir)
         db_path = os.path.join(target_dir, DB_NAME)
-        
+        state_path = os.path.join(target_dir, STATE_NAME)
+
         if not os.path.exists(db_path):
             syslog.syslog(syslog.LOG_ERR, f"Integrity check failed: No database found in {target_dir}")
             continue
 
-        # 1. Load Baseline
-        baseline = {}
-        with open(db_path, "r") as f:
-            for line in f:
-                if "|" in line:
-                    path, f_hash = line.strip().split("|")
-                    baseline[path] = f_hash
-
-        # 2. Scan Current State
-        current_state = {}
-        for root, _, files in os.walk(target_dir):
-            for name in files:
-                if name == DB_NAME: continue
-                path = os.path.join(root, name)
-                f_hash = get_sha256(path)
-                if f_hash: current_state[path] = f_hash
-
-        # 3. Compare and Alert
-        # Check for Missing or Modified files
-        for path, old_hash in baseline.items():
-            if path not in current_state:
-                syslog.syslog(syslog.LOG_CRIT, f"ALERT: Missing file detected: {path}")
-            elif old_hash != current_state[path]:
-                syslog.syslog(syslog.LOG_CRIT, f"ALERT: File modified (hash mismatch): {path}")
-
-        # Check for New files
-        for path in current_state:
-            if path not in baseline:
-                syslog.syslog(syslog.LOG_WARNING, f"ALERT: New file detected: {path}")
+        # 1. Open Baseline (memory-mapped, read as a sorted stream)
+        try:
+            baseline = open_baseline(db_path)
+        except (OSError, ValueError) as exc:
+            syslog.syslog(syslog.LOG_ERR, f"Integrity check failed: {exc}")
+            continue
+
+        # A fast scan trusts unchanged stat metadata, except when a full re-hash is due
+        full = (not fast) or (time.time() - last_full_scan(state_path) >= full_interval)
+
+        # 2. Walk and compare in one pass: walk_files() and the baseline are both
+        # in path_key() order, so a merge-join finds missing/modified/new files
+        # as it goes, without holding either side in memory.
+        with baseline:
+            hashed, reused = compare_stream(baseline, target_dir, full)
+
+        if full:
+            record_full_scan(state_path)
+        mode = "full" if full else "fast"
+        syslog.syslog(
+            syslog.LOG_INFO,
+            f"Integrity scan ({mode}) of {target_dir}: {hashed} hashed, {reused} unchanged by stat",
+        )
+
+def diff_baselines(old_path, new_path):
+    """Prints what changed between two baselines (files or directories holding one); returns the count.
+
+    Directory digests let unchanged subtrees be skipped, so this is fast even
+    for huge baselines, e.g. today's snapshot vs. yesterday's, or two hosts.
+    """
+    paths = [os.path.join(p, DB_NAME) if os.path.isdir(p) else p for p in (old_path, new_path)]
+    changes = 0
+    with open_baseline(paths[0]) as old, open_baseline(paths[1]) as new:
+        for kind, path in diff_trees(old, new):
+            print(f"{kind}: {display_path(path)}")
+            changes += 1
+    return changes
+
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# --watch timing (seconds): quiet time before re-hashing a path, the longest a
+# busy path can be deferred, and how often to run a full reconciliation scan.
+DEFAULT_DEBOUNCE = 0.1
+MAX_DEBOUNCE = 2.0
+DEFAULT_RECONCILE = 900
+
+class Inotify:
+    """Minimal ctypes binding for recursive directory watches."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.add_watch_fn = libc.inotify_add_watch
+        self.add_watch_fn.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.limit_logged = False
+
+    def add_tree(self, top):
+        """Watches top and every directory below it; returns files found there."""
+        found = []
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            wd = self.add_watch_fn(self.fd, path, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC and not self.limit_logged:
+                    self.limit_logged = True
+                    syslog.syslog(syslog.LOG_ERR, "Integrity watch: inotify watch limit reached; relying on reconciliation (raise fs.inotify.max_user_watches)")
+                continue
+            self.dirs[wd] = path
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            found.append(entry.path)
+            except OSError:
+                continue
+        return found
+
+    def read_events(self):
+        """Yields (mask, dir_path, name) for every queued event."""
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\x00")
+            offset += length
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            yield mask, self.dirs.get(wd), name
+
+    def close(self):
+        os.close(self.fd)
+
+def check_path(baseline, path):
+    """Compares one path against the baseline; returns (kind, digest) or None if it matches."""
+    old = baseline.get(path)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return ("missing", None) if old else None
+    entry = get_entry(path)
+    if entry is None:
+        return None
+    if old is None:
+        return ("new", entry[0])
+    if old[0] != entry[0]:
+        return ("modified", entry[0])
+    return None
+
+def watch(directories, debounce=DEFAULT_DEBOUNCE, reconcile=DEFAULT_RECONCILE,
+          full_interval=DEFAULT_FULL_INTERVAL):
+    """Re-checks only paths the kernel reports as changed, plus periodic reconciliation."""
+    syslog.openlog(ident="FILE_INTEGRITY", facility=syslog.LOG_AUTH)
+    targets = [os.fsencode(os.path.abspath(d)) for d in directories]
+    skip_db = os.fsencode(DB_NAME)
+    skip = {skip_db, os.fsencode(STATE_NAME), os.fsencode(DB_NAME + ".tmp")}
+    sep = os.fsencode(os.sep)
+
+    def root_of(path):
+        for top in targets:
+            if path == top or path.startswith(top + sep):
+                return top
+        return None
+
+    def load(top):
+        try:
+            return open_baseline(os.path.join(top, os.fsencode(DB_NAME)))
+        except (OSError, ValueError) as exc:
+            syslog.syslog(syslog.LOG_ERR, f"Integrity watch: no usable baseline in {display_path(top)}: {exc}")
+            return None
+
+    inotify = Inotify()
+    baselines = {top: load(top) for top in targets}
+    for top in targets:
+        inotify.add_tree(top)
+
+    # Initial reconciliation catches anything that changed before the watch started.
+    monitor(directories, fast=True, full_interval=full_interval)
+    next_reconcile = time.monotonic() + reconcile
+    pending = {}    # path -> (first_seen, deadline)
+    reported = {}   # path -> last (kind, digest) alerted, so one change alerts once
+    syslog.syslog(syslog.LOG_INFO, f"Integrity watch started on {len(targets)} directories ({len(inotify.dirs)} watches)")
+
+    def mark(path, now):
+        first = pending.get(path, (now, 0))[0]
+        pending[path] = (first, min(now + debounce, first + MAX_DEBOUNCE))
+
+    poller = select.poll()
+    poller.register(inotify.fd, select.POLLIN)
+    try:
+        while True:
+            now = time.monotonic()
+            wake = next_reconcile
+            if pending:
+                wake = min(wake, min(deadline for _, deadline in pending.values()))
+            poller.poll(max(0, int((wake - now) * 1000)))
+
+            now = time.monotonic()
+            overflow = False
+            for mask, parent, name in inotify.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if parent is None:
+                    continue
+                path = os.path.join(parent, name) if name else parent
+                if name in skip:
+                    # A regenerated baseline is swapped in with a rename.
+                    if name == skip_db and mask & IN_MOVED_TO and parent in baselines:
+                        old = baselines[parent]
+                        baselines[parent] = load(parent)
+                        if old:
+                            old.close()
+                        reported = {p: r for p, r in reported.items() if root_of(p) != parent}
+                    continue
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        for found in inotify.add_tree(path):
+                            mark(found, now)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        # Everything the baseline had under this directory may be gone.
+                        top = root_of(path)
+                        if baselines.get(top):
+                            prefix = path + sep
+                            for base_path, _, _ in baselines[top]:
+                                if base_path.startswith(prefix):
+                                    mark(base_path, now)
+                    continue
+                if not mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    mark(path, now)
+
+            if overflow or now >= next_reconcile:
+                if overflow:
+                    syslog.syslog(syslog.LOG_WARNING, "Integrity watch: inotify queue overflowed; running full reconciliation")
+                monitor(directories, fast=True, full_interval=full_interval)
+                for top in targets:
+                    inotify.add_tree(top)
+                pending.clear()
+                reported.clear()
+                next_reconcile = time.monotonic() + reconcile
+                continue
+
+            for path, (_, deadline) in list(pending.items()):
+                if deadline > now:
+                    continue
+                del pending[path]
+                baseline = baselines.get(root_of(path))
+                if baseline is None:
+                    continue
+                result = check_path(baseline, path)
+                if result is None:
+                    reported.pop(path, None)
+                elif reported.get(path) != result:
+                    reported[path] = result
+                    alert(result[0], path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
+        for baseline in baselines.values():
+            if baseline:
+                baseline.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python3 monitor_integ.py /dir1 /dir2 ...")
+    parser = argparse.ArgumentParser(
+        description="Compare directories against their .integ_db baselines",
+        usage="python3 monitor_integ.py [--fast | --watch] [--full-interval SECONDS] /dir1 /dir2 ...\n"
+              "       python3 monitor_integ.py --diff OLD NEW",
+    )
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Only re-hash files whose size/mtime/ctime/inode changed since the baseline",
+    )
+    parser.add_argument(
+        "--full-interval",
+        type=int,
+        default=DEFAULT_FULL_INTERVAL,
+        help=f"With --fast, force a full re-hash if the last one is older than this (default: {DEFAULT_FULL_INTERVAL}s)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Stay resident and re-check paths as inotify reports changes (Linux)",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=DEFAULT_DEBOUNCE,
+        help=f"With --watch, seconds a path must be quiet before it is re-hashed (default: {DEFAULT_DEBOUNCE})",
+    )
+    parser.add_argument(
+        "--reconcile",
+        type=int,
+        default=DEFAULT_RECONCILE,
+        help=f"With --watch, seconds between full reconciliation scans (default: {DEFAULT_RECONCILE})",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Compare two baselines (.integ_db files or the directories holding them) instead of scanning",
+    )
+    args = parser.parse_args()
+    if args.diff:
+        if len(args.directories) != 2:
+            parser.error("--diff takes exactly two baselines: OLD NEW")
+        try:
+            changed = diff_baselines(*args.directories)
+        except (OSError, ValueError) as exc:
+            parser.exit(2, f"monitor_integ.py: {exc}\n")
+        parser.exit(1 if changed else 0)
+    if args.watch:
+        watch(args.directories, debounce=args.debounce, reconcile=args.reconcile,
+              full_interval=args.full_interval)
     else:
-        monitor(sys.argv[1:])
+        monitor(args.directories, fast=args.fast, full_interval=args.full_interval)
@@ -1,5 +1,5 @@
 #!/usr/bin/env bash
-# Wrapper for tools/service_check.py with list/dry-run/apply modes.
+# Wrapper for tools/service_check.py with list/dry-run/apply/daemon modes.
 
 set -euo pipefail
 
@@ -14,13 +14,13 @@ usage() {
 Usage: run_service_checks.sh [options]
 
 Modes:
-  list | dry-run | apply | backup | restore
+  list | dry-run | apply | daemon | backup | restore
 
 Options:
-  --mode <list|dry-run|apply|backup|restore>
+  --mode <list|dry-run|apply|daemon|backup|restore>
   --config <path>        Service config JSON
   --repeat <n>           Number of runs (apply mode)
-  --interval <seconds>   Delay between runs (apply mode)
+  --interval <seconds>   Delay between runs (apply mode) or default check period (daemon mode)
   --output-dir <path>    Output directory
 USAGE
 }
@@ -46,15 +46,16 @@ list_services() {
     echo "Config not found: $CONFIG" >&2
     exit 1
   fi
-  python3 - <<PY
-import json
-with open("$CONFIG", "r", encoding="utf-8") as f:
-    cfg = json.load(f)
-services = cfg.get("services", [])
-print(f"services: {len(services)}")
-for svc in services:
-    print(f"- {svc.get('name','unnamed')} ({svc.get('type','tcp')}) enabled={svc.get('enabled',True)}")
-PY
+  # service_check.py --list leaves a copy next to its config cache; reuse it
+  # while it is newer than the config instead of starting python.
+  local dir cached
+  dir="$(cd "$(dirname "$CONFIG")" && pwd -P)"
+  cached="artifacts/service_checks/config_cache/$(printf '%s' "${dir#/}/$(basename "$CONFIG")" | tr / _).list"
+  if [ -f "$cached" ] && [ "$cached" -nt "$CONFIG" ]; then
+    cat "$cached"
+  else
+    python3 tools/service_check.py --config "$CONFIG" --list
+  fi
 }
 
 dry_run() {
@@ -66,7 +67,8 @@ dry_run() {
   local out
   out="${OUTPUT_DIR}/dry_run_$(date +%Y%m%d-%H%M%S).json"
   log "Running probes via service_check.py"
-  python3 tools/service_check.py --config "$CONFIG" --output "$out" || true
+  python3 tools/service_check.py --config "$CONFIG" --output "$out" \
+    --store "${OUTPUT_DIR}/results.db" || true
   log "Wrote: $out"
 }
 
@@ -80,7 +82,8 @@ apply_run() {
   for i in $(seq 1 "$REPEAT"); do
     local out
     out="${OUTPUT_DIR}/run_${i}_$(date +%Y%m%d-%H%M%S).json"
-    python3 tools/service_check.py --config "$CONFIG" --output "$out" || true
+    python3 tools/service_check.py --config "$CONFIG" --output "$out" \
+    --store "${OUTPUT_DIR}/results.db" || true
     log "Wrote: $out"
     if [ "$i" -lt "$REPEAT" ]; then
       sleep "$INTERVAL"
@@ -88,6 +91,18 @@ apply_run() {
   done
 }
 
+daemon_run() {
+  if [ ! -f "$CONFIG" ]; then
+    echo "Config not found: $CONFIG" >&2
+    exit 1
+  fi
+  mkdir -p "$OUTPUT_DIR"
+  log "Starting resident checks; appending to ${OUTPUT_DIR}/daemon.jsonl"
+  exec python3 tools/service_check.py --config "$CONFIG" --daemon \
+    --interval "$INTERVAL" --output "${OUTPUT_DIR}/daemon.jsonl" \
+    --store "${OUTPUT_DIR}/results.db"
+}
+
 main() {
   parse_args "$@"
   case "$MODE" in
@@ -100,6 +115,9 @@ main() {
     apply)
       apply_run
       ;;
+    daemon)
+      daemon_run
+      ;;
     backup|restore)
       log "No config changes for service checks; $MODE is a no-op."
       ;;
@@ -3,29 +3,267 @@
 
 Reads a JSON config file and checks only the listed services.
 Results are written to artifacts/service_checks by default.
+
+Protocol modules (ssl, http.client, smtplib, ...) are imported only when a
+service of that type is enabled, see CHECKERS.
 """
 
 import argparse
+import atexit
+import heapq
+import itertools
 import json
+import marshal
+import math
 import os
 import random
+import re
+import select
+import signal
 import socket
-import ssl
 import struct
 import sys
+import threading
 import time
-import urllib.request
-import smtplib
-import poplib
-import ftplib
+from collections import deque
 
 DEFAULT_TIMEOUT = 5
+DEFAULT_CONCURRENCY = 8
+DEFAULT_INTERVAL = 30
+DEFAULT_JITTER = 0.1
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_STORE = os.path.join("artifacts", "service_checks", "results.db")
+DEFAULT_STATE_FILE = os.path.join("artifacts", "service_checks", "health_state.json")
+CONFIG_CACHE_DIR = os.path.join("artifacts", "service_checks", "config_cache")
+CONFIG_CACHE_VERSION = 2  # Bump when prepare_config() changes what it stores
+DEFAULT_PER_HOST = 2
+MAX_SERVICES = 100000  # Guard against a template that expands far more than intended
+FLUSH_INTERVAL = 5.0  # Daemon: rewrite the metrics file and health state at most this often
+TEMPLATE_FIELD = re.compile(r"\{(\w+)([+-]\d+)?\}")
 USER_AGENT = "MACCDC-ServiceCheck/1.0"
+HTTP_MAX_REDIRECTS = 5
+HTTP_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+HTTP_POOL_MAX_IDLE = 4
+HTTP_BODY_LIMIT = 1024 * 1024
+
+# Service type -> (check function, modules it imports), filled by @checker.
+CHECKERS = {}
+
+# Lazy import and config load timings for --startup-report.
+STARTUP = {"imports": {}, "config": None}
+
+# Shared across checks (and daemon cycles) so HTTP/TLS work is not repeated.
+SSL_CONTEXTS = {}
+TLS_SESSIONS = {}
+HTTP_POOL = {}
+POOL_LOCK = threading.Lock()
+
+# Rolling latency windows per service for p50/p95/p99 export.
+METRICS_WINDOW = 500
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+# Per-service health: smoothed RTT for adaptive deadlines and circuit breaker
+# state. Persisted to a state file so one-shot sweeps share it.
+ADAPTIVE_MIN_SAMPLES = 3
+ADAPTIVE_MIN_TIMEOUT = 1.0
+ADAPTIVE_MIN_FACTOR = 0.5  # Never cut a deadline below half of timeout_seconds
+ADAPTIVE_MAX_FACTOR = 2.0  # Slow but healthy services may get up to 2x timeout_seconds
+BREAKER_THRESHOLD = 3  # Consecutive failures before the circuit opens
+PROBE_TIMEOUT = 1.0
+DEFAULT_PORTS = {"http": 80, "https": 443, "smtp": 25, "pop3": 110, "ftp": 21, "dns": 53}
+HEALTH = {}
+HEALTH_LOCK = threading.Lock()
+
+# Append-only result store queried by the `query` subcommand.
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    ts REAL NOT NULL,
+    service TEXT NOT NULL,
+    type TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    detail TEXT,
+    circuit TEXT,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS results_service_ts ON results (service, ts);
+CREATE INDEX IF NOT EXISTS results_ts ON results (ts);
+"""
+
+
+def check_expand_size(count, spec):
+    if count > MAX_SERVICES:
+        raise ValueError(f"expand value {spec!r} gives {count} values, more than {MAX_SERVICES} services")
+
+
+def expand_values(spec):
+    """Values for one "expand" variable: a list, "1-30", a CIDR, or "first-last" addresses.
+
+    Ranges are sized against MAX_SERVICES before any value is built.
+    """
+    if isinstance(spec, list):
+        return spec
+    if isinstance(spec, int):
+        return [spec]
+    text = str(spec).strip()
+    if "/" in text:
+        network = import_module("ipaddress").ip_network(text, strict=False)
+        check_expand_size(network.num_addresses, text)
+        return [str(address) for address in network.hosts()]
+    first, sep, last = text.partition("-")
+    if not sep:
+        return [text]
+    if first.strip().isdigit() and last.strip().isdigit():
+        check_expand_size(int(last) - int(first) + 1, text)
+        return list(range(int(first), int(last) + 1))
+    ipaddress = import_module("ipaddress")
+    first, last = ipaddress.ip_address(first.strip()), ipaddress.ip_address(last.strip())
+    check_expand_size(int(last) - int(first) + 1, text)
+    return [str(ipaddress.ip_address(value)) for value in range(int(first), int(last) + 1)]
+
+
+def substitute(value, variables):
+    """Fill {var}, {var+N} and {var-N} in every string of a template; other braces are kept."""
+    if isinstance(value, dict):
+        return {key: substitute(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute(item, variables) for item in value]
+    if not isinstance(value, str) or "{" not in value:
+        return value
+
+    def fill(match):
+        name, offset = match.group(1), match.group(2)
+        if name not in variables:
+            return match.group(0)
+        if offset:
+            return str(int(variables[name]) + int(offset))
+        return str(variables[name])
+
+    match = TEMPLATE_FIELD.fullmatch(value)
+    if match and not match.group(2) and match.group(1) in variables:
+        return variables[match.group(1)]  # "{port}" alone keeps the value's type
+    return TEMPLATE_FIELD.sub(fill, value)
+
 
+def expand_services(config):
+    """Services with an "expand" object become one service per combination of its values.
 
-def load_config(path):
+    Top-level scalars such as team_number can also be used in templates.
+    """
+    defaults = {
+        key: value for key, value in config.items() if isinstance(value, (str, int, float))
+    }
+    services = []
+    names = set()
+    for service in config.get("services", []):
+        expand = service.get("expand")
+        if not expand:
+            services.append(service)
+            names.add(service.get("name", "unnamed"))
+            continue
+        template = {key: value for key, value in service.items() if key != "expand"}
+        keys = list(expand)
+        values = [expand_values(expand[key]) for key in keys]
+        if len(services) + math.prod(len(v) for v in values) > MAX_SERVICES:
+            raise ValueError(f"templates expand to more than {MAX_SERVICES} services")
+        for combo in itertools.product(*values):
+            item = substitute(template, dict(defaults, **dict(zip(keys, combo))))
+            if item.get("name") == template.get("name"):
+                # The name had no placeholder; make each copy unique.
+                item["name"] = "_".join([str(template.get("name", "unnamed"))] + [str(v) for v in combo])
+            if item["name"] in names:
+                raise ValueError(f"template {template.get('name')} repeats service name {item['name']}")
+            names.add(item["name"])
+            services.append(item)
+    config["services"] = services
+    return config
+
+
+def prepare_config(config):
+    expand_services(config)
+    for service in config.get("services", []):
+        service["type"] = str(service.get("type", "tcp")).lower()
+    return config
+
+
+def config_cache_path(path, cache_dir, suffix):
+    """Cache file for a config, e.g. config_cache/root_package_config_services.json.marshal."""
+    return os.path.join(cache_dir, os.path.abspath(path).strip(os.sep).replace(os.sep, "_") + suffix)
+
+
+def load_config(path, cache_dir=CONFIG_CACHE_DIR):
+    """Parsed config, reusing a marshal cache of prepare_config() output.
+
+    The cache is keyed on the file's mtime and size, so edits are picked up
+    on the next load.
+    """
+    start = time.perf_counter()
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, CONFIG_CACHE_VERSION, sys.version_info[:2])
+    cache_path = config_cache_path(path, cache_dir, ".marshal") if cache_dir else None
+    if cache_path:
+        try:
+            with open(cache_path, "rb") as f:
+                cached_key, config = marshal.load(f)
+            if cached_key == key:
+                STARTUP["config"] = ("cached", time.perf_counter() - start)
+                return config
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
     with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        config = prepare_config(json.load(f))
+    if cache_path:
+        try:
+            ensure_dir(cache_dir)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                marshal.dump((key, config), f)
+            os.replace(tmp_path, cache_path)
+        except (OSError, ValueError):
+            pass
+    STARTUP["config"] = ("parsed", time.perf_counter() - start)
+    return config
+
+
+def import_module(name):
+    """Import name on first use, recording how long it took."""
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        __import__(name)
+        module = sys.modules[name]
+        STARTUP["imports"][name] = time.perf_counter() - start
+    return module
+
+
+def checker(*types, modules=()):
+    """Register a check function for service types; modules are imported lazily."""
+    def register(func):
+        for service_type in types:
+            CHECKERS[service_type] = (func, modules)
+        return func
+    return register
+
+
+def load_checkers(services):
+    """Import the protocol modules needed by the enabled services, before checks start."""
+    for service in services:
+        if service.get("enabled", True):
+            _, modules = CHECKERS.get(service.get("type", "tcp").lower(), CHECKERS["tcp"])
+            for name in modules:
+                import_module(name)
+
+
+def startup_report(out=sys.stderr):
+    """Where start-up time went, in the spirit of python3 -X importtime."""
+    print(f"startup: {STARTUP['main'] * 1000:.1f} ms cpu before main()", file=out)
+    if STARTUP["config"]:
+        state, seconds = STARTUP["config"]
+        print(f"config: {seconds * 1000:.2f} ms ({state})", file=out)
+    for name, seconds in STARTUP["imports"].items():
+        print(f"import {name}: {seconds * 1000:.2f} ms", file=out)
 
 
 def ensure_dir(path):
@@ -36,36 +274,183 @@ def now_ts():
     return time.strftime("%Y%m%d-%H%M%S")
 
 
-def record_result(results, name, service_type, ok, duration, detail, skipped=False):
-    results.append(
-        {
-            "name": name,
-            "type": service_type,
-            "ok": ok,
-            "skipped": skipped,
-            "duration_ms": int(duration * 1000),
-            "detail": detail,
+def record_result(
+    results, name, service_type, ok, duration, detail, skipped=False, timings=None,
+    extra=None,
+):
+    result = {
+        "name": name,
+        "type": service_type,
+        "ok": ok,
+        "skipped": skipped,
+        "duration_ms": int(duration * 1000),
+        "detail": detail,
+    }
+    if timings:
+        result["timings_ms"] = {
+            phase: round(value * 1000, 1) for phase, value in timings.items()
         }
-    )
+    if extra:
+        result.update(extra)
+    results.append(result)
+
+
+def add_phase(timings, phase, start):
+    """Accumulate perf_counter time since start into timings[phase]."""
+    timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+
+def resolve(host, port, timings, socktype=socket.SOCK_STREAM):
+    """All addresses for host in getaddrinfo order, timing the lookup as the dns phase."""
+    start = time.perf_counter()
+    try:
+        infos = socket.getaddrinfo(host, port, type=socktype)
+    finally:
+        add_phase(timings, "dns", start)
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
 
+def try_addresses(addresses, connect):
+    """Return connect(address) for the first address that works, like socket.create_connection."""
+    error = None
+    for address in addresses:
+        try:
+            return connect(address)
+        except OSError as exc:
+            error = exc
+    raise error
 
+
+@checker("tcp")
 def check_tcp(service, timeout):
     host = service["host"]
     port = int(service.get("port", 0))
     if port <= 0:
         return False, "missing port"
-    start = time.time()
+    timings = {}
     try:
-        with socket.create_connection((host, port), timeout=timeout):
-            pass
-        return True, f"connected to {host}:{port}"
+        addresses = resolve(host, port, timings)
+        start = time.perf_counter()
+        with try_addresses(addresses, lambda a: socket.create_connection((a, port), timeout=timeout)):
+            add_phase(timings, "connect", start)
+        return True, f"connected to {host}:{port}", timings
     except Exception as exc:
-        return False, f"tcp error: {exc}"
-    finally:
-        _ = time.time() - start
+        return False, f"tcp error: {exc}", timings
+
+
+def get_ssl_context(verify):
+    """Return one shared SSLContext per verify mode so sessions can be resumed."""
+    import ssl
+
+    with POOL_LOCK:
+        context = SSL_CONTEXTS.get(verify)
+        if context is None:
+            if verify:
+                context = ssl.create_default_context()
+            else:
+                context = ssl._create_unverified_context()
+            SSL_CONTEXTS[verify] = context
+        return context
+
+
+def open_http_connection(key, timeout, timings):
+    import http.client
 
+    scheme, host, port, verify = key
+    addresses = resolve(host, port, timings)
+    start = time.perf_counter()
+    sock = try_addresses(addresses, lambda a: socket.create_connection((a, port), timeout=timeout))
+    add_phase(timings, "connect", start)
+    if scheme != "https":
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        conn.sock = sock
+        return conn, False
 
-def check_http(service, timeout, scheme):
+    context = get_ssl_context(verify)
+    start = time.perf_counter()
+    try:
+        tls_sock = context.wrap_socket(
+            sock, server_hostname=host, session=TLS_SESSIONS.get(key)
+        )
+    except Exception:
+        sock.close()
+        raise
+    add_phase(timings, "tls", start)
+    conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=context)
+    conn.sock = tls_sock
+    return conn, tls_sock.session_reused
+
+
+def acquire_http_connection(key):
+    with POOL_LOCK:
+        idle = HTTP_POOL.get(key)
+        if idle:
+            return idle.pop()
+    return None
+
+
+def release_http_connection(key, conn):
+    with POOL_LOCK:
+        idle = HTTP_POOL.setdefault(key, [])
+        if len(idle) < HTTP_POOL_MAX_IDLE:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def http_fetch(key, target, timeout, keepalive, timings):
+    """GET target over a pooled or fresh connection.
+
+    Returns (status, location, body, conn_state) where conn_state is one of
+    reused, resumed (new TCP, resumed TLS session) or new.
+    """
+    import http.client
+
+    headers = {"User-Agent": USER_AGENT, "Connection": "keep-alive" if keepalive else "close"}
+    conn = acquire_http_connection(key) if keepalive else None
+    conn_state = "reused"
+    while True:
+        if conn is None:
+            conn, resumed = open_http_connection(key, timeout, timings)
+            conn_state = "resumed" if resumed else "new"
+        try:
+            start = time.perf_counter()
+            conn.request("GET", target, headers=headers)
+            resp = conn.getresponse()
+            add_phase(timings, "first_byte", start)
+            break
+        except (http.client.RemoteDisconnected, ConnectionError):
+            conn.close()
+            conn = None
+            # An idle pooled connection may have been closed by the server; retry once fresh.
+            if conn_state != "reused":
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+    try:
+        start = time.perf_counter()
+        body = resp.read(HTTP_BODY_LIMIT)
+        add_phase(timings, "payload", start)
+    except Exception:
+        conn.close()
+        raise
+
+    if key[0] == "https" and conn.sock is not None:
+        TLS_SESSIONS[key] = conn.sock.session
+    if keepalive and resp.isclosed() and not resp.will_close:
+        release_http_connection(key, conn)
+    else:
+        conn.close()
+    return resp.status, resp.getheader("Location"), body, conn_state
+
+
+@checker("http", "https", modules=("ssl", "http.client", "urllib.parse"))
+def check_http(service, timeout):
+    import urllib.parse
+
+    scheme = service.get("type", "http").lower()
     host = service["host"]
     port = int(service.get("port", 443 if scheme == "https" else 80))
     path = service.get("path", "/")
@@ -74,208 +459,1259 @@ def check_http(service, timeout, scheme):
     expect_statuses = service.get("expect_statuses")
     expect_contains = service.get("expect_contains")
     verify_tls = bool(service.get("tls_verify", True))
+    keepalive = bool(service.get("keepalive", False))
 
     if expect_statuses is None:
         expect_statuses = [expect_status]
     else:
         expect_statuses = [int(x) for x in expect_statuses]
 
-    context = None
-    if scheme == "https" and not verify_tls:
-        context = ssl._create_unverified_context()
-
-    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
-    start = time.time()
+    timings = {}
     try:
-        with urllib.request.urlopen(req, timeout=timeout, context=context) as resp:
-            status = resp.getcode()
-            status_ok = status in expect_statuses
-            if expect_contains is not None:
-                body = resp.read(1024 * 1024).decode("utf-8", errors="replace")
-                ok = status_ok and (expect_contains in body)
-            else:
-                ok = status_ok
-            return ok, f"status={status} url={url}"
+        # Follow redirects like urllib did so existing expect_status values still apply.
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                return False, f"http error: unsupported url {url}", timings
+            key = (
+                parts.scheme,
+                parts.hostname,
+                parts.port or (443 if parts.scheme == "https" else 80),
+                verify_tls,
+            )
+            target = parts.path or "/"
+            if parts.query:
+                target += "?" + parts.query
+            status, location, body, conn_state = http_fetch(
+                key, target, timeout, keepalive, timings
+            )
+            if status in HTTP_REDIRECT_STATUSES and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            break
+        else:
+            return False, f"http error: too many redirects url={url}", timings
+
+        ok = status in expect_statuses
+        if expect_contains is not None:
+            ok = ok and (expect_contains in body.decode("utf-8", errors="replace"))
+        return ok, f"status={status} url={url} conn={conn_state}", timings
     except Exception as exc:
-        return False, f"http error: {exc}"
-    finally:
-        _ = time.time() - start
+        return False, f"http error: {exc}", timings
 
 
+@checker("smtp", modules=("ssl", "smtplib"))
 def check_smtp(service, timeout):
+    import smtplib
+    import ssl
+
     host = service["host"]
     port = int(service.get("port", 25))
     starttls = bool(service.get("starttls", False))
     username = service.get("username")
     password = service.get("password")
 
-    start = time.time()
+    timings = {}
     try:
-        with smtplib.SMTP(host=host, port=port, timeout=timeout) as smtp:
+        resolve(host, port, timings)
+        # connect covers the TCP connect and the 220 greeting. Connecting by name
+        # lets smtplib try every address and check STARTTLS certificates against it.
+        start = time.perf_counter()
+        smtp = smtplib.SMTP(host, port, timeout=timeout)
+        add_phase(timings, "connect", start)
+        with smtp:
+            start = time.perf_counter()
             smtp.ehlo_or_helo_if_needed()
+            add_phase(timings, "handshake", start)
             if starttls:
+                start = time.perf_counter()
                 smtp.starttls(context=ssl.create_default_context())
+                add_phase(timings, "tls", start)
+                start = time.perf_counter()
                 smtp.ehlo()
+                add_phase(timings, "handshake", start)
             if username and password:
+                start = time.perf_counter()
                 smtp.login(username, password)
+                add_phase(timings, "handshake", start)
+            start = time.perf_counter()
             code, _ = smtp.noop()
+            add_phase(timings, "payload", start)
         ok = code == 250
-        return ok, f"smtp noop code={code}"
+        return ok, f"smtp noop code={code}", timings
     except Exception as exc:
-        return False, f"smtp error: {exc}"
-    finally:
-        _ = time.time() - start
+        return False, f"smtp error: {exc}", timings
 
 
+@checker("pop3", modules=("poplib",))
 def check_pop3(service, timeout):
+    import poplib
+
     host = service["host"]
     port = int(service.get("port", 110))
     use_tls = bool(service.get("tls", False))
     username = service.get("username")
     password = service.get("password")
 
-    start = time.time()
+    timings = {}
     try:
-        if use_tls:
-            pop = poplib.POP3_SSL(host, port, timeout=timeout)
-        else:
-            pop = poplib.POP3(host, port, timeout=timeout)
+        addresses = resolve(host, port, timings)
+        # connect covers the TCP connect, implicit TLS and the +OK greeting.
+        start = time.perf_counter()
+        pop_class = poplib.POP3_SSL if use_tls else poplib.POP3
+        pop = try_addresses(addresses, lambda a: pop_class(a, port, timeout=timeout))
+        add_phase(timings, "connect", start)
         with pop:
             if username and password:
+                start = time.perf_counter()
                 pop.user(username)
                 pop.pass_(password)
+                add_phase(timings, "handshake", start)
+            start = time.perf_counter()
             pop.stat()
-        return True, "pop3 stat ok"
+            add_phase(timings, "payload", start)
+        return True, "pop3 stat ok", timings
     except Exception as exc:
-        return False, f"pop3 error: {exc}"
-    finally:
-        _ = time.time() - start
+        return False, f"pop3 error: {exc}", timings
 
 
+@checker("ftp", modules=("ftplib",))
 def check_ftp(service, timeout):
+    import ftplib
+
     host = service["host"]
     port = int(service.get("port", 21))
     use_tls = bool(service.get("tls", False))
     username = service.get("username")
     password = service.get("password")
 
-    start = time.time()
+    timings = {}
     try:
-        if use_tls:
-            ftp = ftplib.FTP_TLS()
-            ftp.connect(host, port, timeout=timeout)
-            if username and password:
-                ftp.login(username, password)
+        addresses = resolve(host, port, timings)
+        ftp = ftplib.FTP_TLS() if use_tls else ftplib.FTP()
+        # connect covers the TCP connect and the 220 greeting.
+        start = time.perf_counter()
+        try_addresses(addresses, lambda a: ftp.connect(a, port, timeout=timeout))
+        add_phase(timings, "connect", start)
+        start = time.perf_counter()
+        if username and password:
+            ftp.login(username, password)
+            if use_tls:
                 ftp.prot_p()
-            else:
-                ftp.login()
         else:
-            ftp = ftplib.FTP()
-            ftp.connect(host, port, timeout=timeout)
-            if username and password:
-                ftp.login(username, password)
-            else:
-                ftp.login()
+            ftp.login()
+        # FTP_TLS.login performs AUTH TLS, so TLS time is folded into handshake.
+        add_phase(timings, "handshake", start)
+        start = time.perf_counter()
         ftp.pwd()
+        add_phase(timings, "payload", start)
         ftp.quit()
-        return True, "ftp pwd ok"
+        return True, "ftp pwd ok", timings
     except Exception as exc:
-        return False, f"ftp error: {exc}"
-    finally:
-        _ = time.time() - start
+        return False, f"ftp error: {exc}", timings
+
 
+DNS_TYPES = {"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "MX": 15, "TXT": 16, "AAAA": 28, "SRV": 33}
+DNS_TYPE_NAMES = {value: key for key, value in DNS_TYPES.items()}
+DNS_RCODES = {0: "NOERROR", 1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 4: "NOTIMP", 5: "REFUSED"}
+DNS_HEADER = struct.Struct("!HHHHHH")
+DNS_RR = struct.Struct("!HHIH")
+DNS_FLAG_TC = 0x0200
+DNS_EDNS_PAYLOAD = 1232  # EDNS(0) UDP size that avoids IP fragmentation
+DNS_RETRY_INTERVAL = 1.0  # Resend unanswered UDP queries this often (capped at timeout / 3)
 
-def build_dns_query(name):
-    tid = random.randint(0, 65535)
+
+def build_dns_query(name, qtype=1, tid=None, edns=False):
+    if tid is None:
+        tid = random.randint(0, 65535)
     flags = 0x0100
     qdcount = 1
-    header = struct.pack("!HHHHHH", tid, flags, qdcount, 0, 0, 0)
+    header = DNS_HEADER.pack(tid, flags, qdcount, 0, 0, 1 if edns else 0)
     qname = b"".join(
         bytes([len(label)]) + label.encode("ascii") for label in name.split(".") if label
     ) + b"\x00"
-    qtype = 1  # A
     qclass = 1  # IN
     question = qname + struct.pack("!HH", qtype, qclass)
+    if edns:
+        # OPT pseudo-record: root name, type 41, class = our UDP payload size
+        question += b"\x00" + DNS_RR.pack(41, DNS_EDNS_PAYLOAD, 0, 0)
     return tid, header + question
 
 
+def read_dns_name(data, offset):
+    """Decode a (possibly compressed) name; returns (lowercase name, offset after it)."""
+    labels = []
+    end = None
+    for _ in range(128):
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+        elif length == 0:
+            return ".".join(labels).lower(), (end if end is not None else offset + 1)
+        else:
+            labels.append(data[offset + 1:offset + 1 + length].decode("ascii", "replace"))
+            offset += 1 + length
+    raise ValueError("dns name compression loop")
+
+
+def parse_dns_response(data):
+    tid, flags, qdcount, ancount, _ns, _ar = DNS_HEADER.unpack_from(data, 0)
+    offset = DNS_HEADER.size
+    question = None
+    for _ in range(qdcount):
+        qname, offset = read_dns_name(data, offset)
+        qtype, _qclass = struct.unpack_from("!HH", data, offset)
+        offset += 4
+        question = question or (qname, qtype)
+    answers = []
+    if flags & DNS_FLAG_TC:
+        ancount = 0  # partial answer; it will be re-asked over TCP
+    for _ in range(ancount):
+        _name, offset = read_dns_name(data, offset)
+        rtype, _rclass, _ttl, rdlength = DNS_RR.unpack_from(data, offset)
+        offset += DNS_RR.size
+        rdata = offset
+        offset += rdlength
+        if offset > len(data):
+            raise ValueError("dns answer truncated")
+        if rtype == 1 and rdlength == 4:
+            value = socket.inet_ntop(socket.AF_INET, data[rdata:offset])
+        elif rtype == 28 and rdlength == 16:
+            value = socket.inet_ntop(socket.AF_INET6, data[rdata:offset])
+        elif rtype == 33:
+            port = struct.unpack_from("!H", data, rdata + 4)[0]
+            value = f"{read_dns_name(data, rdata + 6)[0]}:{port}"
+        elif rtype in (2, 5, 12):
+            value = read_dns_name(data, rdata)[0]
+        else:
+            value = f"{rdlength}b"
+        answers.append((rtype, value))
+    return {
+        "tid": tid,
+        "rcode": flags & 0x000F,
+        "truncated": bool(flags & DNS_FLAG_TC),
+        "question": question,
+        "answers": answers,
+    }
+
+
+def dns_result(query, response, rtt, transport, error=None):
+    result = {"name": query[0], "type": query[1], "transport": transport, "rtt": rtt, "error": error}
+    if response is not None:
+        result["rcode"] = response["rcode"]
+        result["answers"] = [value for rtype, value in response["answers"] if rtype == query[1]]
+    return result
+
+
+def dns_probe(address, port, queries, timeout, edns=True):
+    """Run all (name, qtype) queries at once over one UDP socket; returns one result per query.
+
+    Responses are matched by transaction ID and question, and unanswered
+    queries are resent every retry interval until the timeout. Truncated
+    answers are re-asked at once over one pipelined TCP connection (RFC 7766),
+    serviced by the same select loop. rtt is measured from the first send,
+    so it includes any retransmissions or TCP fallback.
+    """
+    results = [None] * len(queries)
+    pending = {}   # tid -> query index, still waiting on UDP
+    packets = {}
+    for index, (name, qtype) in enumerate(queries):
+        tid = random.randint(0, 65535)
+        while tid in pending:
+            tid = random.randint(0, 65535)
+        pending[tid], packets[tid] = index, build_dns_query(name, qtype, tid, edns)[1]
+
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    retry = max(0.05, min(DNS_RETRY_INTERVAL, timeout / 3))
+    tcp_pending = {}   # tid -> query index, re-asked over TCP
+    tcp_sock = None
+    tcp_buffer = b""
+    udp_error = tcp_error = "timeout"
+    start = time.perf_counter()
+    deadline = start + timeout
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.connect((address, port))
+        for tid in pending:
+            sock.send(packets[tid])
+        next_retry = start + retry
+        while pending or tcp_pending:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if pending and now >= next_retry:
+                for tid in pending:
+                    sock.send(packets[tid])
+                next_retry = now + retry
+            wait = deadline - now
+            if pending:
+                wait = min(wait, next_retry - now)
+            readable, _, _ = select.select(
+                [s for s in (sock if pending else None, tcp_sock) if s is not None], [], [], max(0.0, wait)
+            )
+
+            if tcp_sock is not None and tcp_sock in readable:
+                chunk = tcp_sock.recv(65535)
+                if not chunk:
+                    for index in tcp_pending.values():
+                        results[index] = dns_result(queries[index], None, None, "tcp",
+                                                    "tcp fallback: connection closed")
+                    tcp_pending.clear()
+                    tcp_sock.close()
+                    tcp_sock = None
+                    continue
+                tcp_buffer += chunk
+                while len(tcp_buffer) >= 2 and len(tcp_buffer) >= 2 + struct.unpack_from("!H", tcp_buffer)[0]:
+                    size = struct.unpack_from("!H", tcp_buffer)[0]
+                    data, tcp_buffer = tcp_buffer[2:2 + size], tcp_buffer[2 + size:]
+                    response = parse_dns_response(data)
+                    index = tcp_pending.pop(response["tid"], None)
+                    if index is not None:
+                        results[index] = dns_result(queries[index], response, time.perf_counter() - start, "tcp")
+
+            if sock not in readable:
+                continue
+            try:
+                data = sock.recv(65535)
+            except ConnectionRefusedError:
+                # ICMP port unreachable: nothing is listening, stop waiting on UDP
+                for index in pending.values():
+                    results[index] = dns_result(queries[index], None, None, "udp", "port unreachable")
+                pending.clear()
+                continue
+            try:
+                response = parse_dns_response(data)
+            except (ValueError, struct.error, IndexError):
+                continue
+            index = pending.get(response["tid"])
+            if index is None or response["question"] != (queries[index][0].lower().rstrip("."), queries[index][1]):
+                continue  # stale retransmit answer or spoofed/mismatched reply
+            del pending[response["tid"]]
+            if not response["truncated"]:
+                results[index] = dns_result(queries[index], response, time.perf_counter() - start, "udp")
+                continue
+            try:
+                if tcp_sock is None:
+                    tcp_sock = socket.socket(family, socket.SOCK_STREAM)
+                    tcp_sock.settimeout(max(0.001, deadline - time.perf_counter()))
+                    tcp_sock.connect((address, port))
+                tcp_sock.sendall(struct.pack("!H", len(packets[response["tid"]])) + packets[response["tid"]])
+                tcp_pending[response["tid"]] = index
+            except OSError as exc:
+                tcp_error = f"tcp fallback: {exc}"
+                results[index] = dns_result(queries[index], None, None, "tcp", tcp_error)
+                if tcp_sock is not None:
+                    tcp_sock.close()
+                    tcp_sock = None
+    except (OSError, ValueError, struct.error, IndexError) as exc:
+        udp_error = tcp_error = str(exc)
+    finally:
+        sock.close()
+        if tcp_sock is not None:
+            tcp_sock.close()
+
+    for index in pending.values():
+        results[index] = dns_result(queries[index], None, None, "udp", udp_error)
+    for index in tcp_pending.values():
+        results[index] = dns_result(queries[index], None, None, "tcp", tcp_error)
+    return results
+
+
+def dns_queries(service):
+    """(name, qtype) pairs from "queries" (dicts or "TYPE name" strings) or the legacy query_name."""
+    entries = service.get("queries") or [{"name": service.get("query_name", "example.com"), "type": "A"}]
+    queries = []
+    for entry in entries:
+        if isinstance(entry, str):
+            qtype, _, name = entry.partition(" ") if " " in entry else ("A", "", entry)
+            entry = {"name": name.strip(), "type": qtype}
+        type_name = str(entry.get("type", "A")).upper()
+        if type_name not in DNS_TYPES:
+            raise ValueError(f"unsupported query type {type_name}")
+        qtype = DNS_TYPES[type_name]
+        name = entry["name"].rstrip(".")
+        if qtype == DNS_TYPES["PTR"] and not name.endswith(".arpa"):
+            # PTR given as an address: query its reverse name
+            name = import_module("ipaddress").ip_address(name).reverse_pointer
+        queries.append((name, qtype, int(entry.get("min_answers", 1))))
+    return queries
+
+
+@checker("dns")
 def check_dns(service, timeout):
     host = service["host"]
     port = int(service.get("port", 53))
-    query_name = service.get("query_name", "example.com")
 
-    start = time.time()
+    timings = {}
     try:
-        tid, payload = build_dns_query(query_name)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(timeout)
-        with sock:
-            sock.sendto(payload, (host, port))
-            data, _ = sock.recvfrom(512)
-        if len(data) < 12:
-            return False, "dns response too short"
-        resp_tid, resp_flags, _qd, ancount, _ns, _ar = struct.unpack("!HHHHHH", data[:12])
-        rcode = resp_flags & 0x000F
-        ok = (resp_tid == tid) and (rcode == 0) and (ancount >= 1)
-        return ok, f"rcode={rcode} ancount={ancount}"
+        queries = dns_queries(service)
+        # UDP gives no connect error to fall back on, so use the first address.
+        address = resolve(host, port, timings, socket.SOCK_DGRAM)[0]
+        start = time.perf_counter()
+        results = dns_probe(address, port, [q[:2] for q in queries], timeout,
+                            edns=service.get("edns", True))
+        add_phase(timings, "payload", start)
+        ok = True
+        parts = []
+        for (_, _, min_answers), result in zip(queries, results):
+            label = f"{DNS_TYPE_NAMES.get(result['type'], result['type'])} {result['name']}"
+            if result["error"]:
+                ok = False
+                parts.append(f"{label} {result['error']}")
+                continue
+            timings[f"rtt {label}"] = result["rtt"]
+            rcode, answers = result["rcode"], result["answers"]
+            if rcode != 0 or len(answers) < min_answers:
+                ok = False
+            status = ",".join(answers[:2]) if answers else "no answer"
+            if rcode:
+                status = DNS_RCODES.get(rcode, f"rcode={rcode}")
+            tcp = " tcp" if result["transport"] == "tcp" else ""
+            parts.append(f"{label}={status} {result['rtt'] * 1000:.1f}ms{tcp}")
+        return ok, "; ".join(parts), timings
     except Exception as exc:
-        return False, f"dns error: {exc}"
-    finally:
-        _ = time.time() - start
+        return False, f"dns error: {exc}", timings
 
 
-def run_checks(config, output_path):
-    timeout = int(config.get("timeout_seconds", DEFAULT_TIMEOUT))
-    services = config.get("services", [])
-    results = []
+def observe_result(result):
+    """Add one recorded result to the rolling per-service latency windows."""
+    if result.get("skipped"):
+        return
+    with METRICS_LOCK:
+        entry = METRICS.get(result["name"])
+        if entry is None:
+            entry = {
+                "type": result["type"],
+                "total": deque(maxlen=METRICS_WINDOW),
+                "phases": {},
+                "count": 0,
+                "failures": 0,
+                "up": 0,
+            }
+            METRICS[result["name"]] = entry
+        # Open-circuit results are probes or no-ops; keep them out of the latency windows.
+        if result.get("circuit") != "open":
+            entry["total"].append(result["duration_ms"] / 1000.0)
+            for phase, value in result.get("timings_ms", {}).items():
+                window = entry["phases"].setdefault(phase, deque(maxlen=METRICS_WINDOW))
+                window.append(value / 1000.0)
+        entry["count"] += 1
+        entry["failures"] += 0 if result["ok"] else 1
+        entry["up"] = 1 if result["ok"] else 0
 
-    for service in services:
-        name = service.get("name", "unnamed")
-        service_type = service.get("type", "tcp").lower()
-        enabled = service.get("enabled", True)
-        start = time.time()
 
-        if not enabled:
-            duration = time.time() - start
-            record_result(
-                results,
-                name,
-                service_type,
-                True,
-                duration,
-                "skipped (disabled)",
-                skipped=True,
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile.
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def render_metrics():
+    """Render the rolling windows in Prometheus text exposition format."""
+    lines = [
+        "# HELP service_check_up 1 if the most recent check passed.",
+        "# TYPE service_check_up gauge",
+    ]
+    with METRICS_LOCK:
+        snapshot = {
+            name: (entry["type"], entry["up"], entry["count"], entry["failures"],
+                   sorted(entry["total"]),
+                   {p: sorted(w) for p, w in entry["phases"].items()})
+            for name, entry in METRICS.items()
+        }
+    for name, (service_type, up, _count, _failures, _total, _phases) in sorted(snapshot.items()):
+        lines.append(f'service_check_up{{service="{name}",type="{service_type}"}} {up}')
+
+    lines += [
+        "# HELP service_check_checks_total Checks recorded (kept across runs with --metrics-file).",
+        "# TYPE service_check_checks_total counter",
+    ]
+    for name, (_type, _up, count, _failures, _total, _phases) in sorted(snapshot.items()):
+        lines.append(f'service_check_checks_total{{service="{name}"}} {count}')
+    lines += [
+        "# HELP service_check_failures_total Failed checks recorded (kept across runs with --metrics-file).",
+        "# TYPE service_check_failures_total counter",
+    ]
+    for name, (_type, _up, _count, failures, _total, _phases) in sorted(snapshot.items()):
+        lines.append(f'service_check_failures_total{{service="{name}"}} {failures}')
+
+    lines += [
+        f"# HELP service_check_duration_seconds Check duration over the last {METRICS_WINDOW} checks.",
+        "# TYPE service_check_duration_seconds summary",
+    ]
+    for name, (_type, _up, _count, _failures, total, _phases) in sorted(snapshot.items()):
+        for q in METRICS_QUANTILES:
+            lines.append(
+                f'service_check_duration_seconds{{service="{name}",quantile="{q}"}} '
+                f"{percentile(total, q):.6f}"
             )
-            print(f"SKIP {name} ({service_type}): disabled")
+        lines.append(f'service_check_duration_seconds_sum{{service="{name}"}} {sum(total):.6f}')
+        lines.append(f'service_check_duration_seconds_count{{service="{name}"}} {len(total)}')
+
+    lines += [
+        f"# HELP service_check_phase_seconds Per-phase time over the last {METRICS_WINDOW} checks.",
+        "# TYPE service_check_phase_seconds summary",
+    ]
+    for name, (_type, _up, _count, _failures, _total, phases) in sorted(snapshot.items()):
+        for phase, values in sorted(phases.items()):
+            labels = f'service="{name}",phase="{phase}"'
+            for q in METRICS_QUANTILES:
+                lines.append(
+                    f'service_check_phase_seconds{{{labels},quantile="{q}"}} '
+                    f"{percentile(values, q):.6f}"
+                )
+            lines.append(f"service_check_phase_seconds_sum{{{labels}}} {sum(values):.6f}")
+            lines.append(f"service_check_phase_seconds_count{{{labels}}} {len(values)}")
+    return "\n".join(lines) + "\n"
+
+
+def load_metrics(path):
+    """Restore the latency windows saved next to a metrics file, so one-shot runs accumulate."""
+    state_path = f"{path}.state.json"
+    if not os.path.exists(state_path):
+        return
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError) as exc:
+        print(f"Ignoring unreadable metrics state {state_path}: {exc}")
+        return
+    with METRICS_LOCK:
+        for name, entry in saved.items():
+            entry["total"] = deque(entry["total"], maxlen=METRICS_WINDOW)
+            entry["phases"] = {
+                phase: deque(values, maxlen=METRICS_WINDOW)
+                for phase, values in entry["phases"].items()
+            }
+            METRICS[name] = entry
+
+
+def write_metrics_file(path):
+    """Atomically replace path so a node_exporter textfile collector never reads a partial file.
+
+    The windows are also saved to <path>.state.json for load_metrics().
+    """
+    ensure_dir(os.path.dirname(path) or ".")
+    with METRICS_LOCK:
+        saved = {
+            name: dict(
+                entry,
+                total=list(entry["total"]),
+                phases={phase: list(values) for phase, values in entry["phases"].items()},
+            )
+            for name, entry in METRICS.items()
+        }
+    for target, text in ((f"{path}.state.json", json.dumps(saved)), (path, render_metrics())):
+        tmp_path = f"{target}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, target)
+
+
+def start_metrics_server(port, bind="127.0.0.1"):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((bind, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Metrics: http://{bind}:{port}/metrics", flush=True)
+    return server
+
+
+def open_store(path):
+    sqlite3 = import_module("sqlite3")
+    ensure_dir(os.path.dirname(path) or ".")
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(STORE_SCHEMA)
+    return db
+
+
+def store_results(db, results, ts=None):
+    """Append recorded results (skipped ones are left out) in one transaction."""
+    rows = []
+    for result in results:
+        if result.get("skipped"):
             continue
+        timings = result.get("timings_ms")
+        rows.append((
+            result.get("ts", ts if ts is not None else time.time()),
+            result["name"],
+            result["type"],
+            1 if result["ok"] else 0,
+            result["duration_ms"],
+            result["detail"],
+            result.get("circuit"),
+            json.dumps(timings, separators=(",", ":")) if timings else None,
+        ))
+    with db:
+        db.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
 
-        if service_type in ("http", "https"):
-            ok, detail = check_http(service, timeout, service_type)
-        elif service_type == "smtp":
-            ok, detail = check_smtp(service, timeout)
-        elif service_type == "pop3":
-            ok, detail = check_pop3(service, timeout)
-        elif service_type == "ftp":
-            ok, detail = check_ftp(service, timeout)
-        elif service_type == "dns":
-            ok, detail = check_dns(service, timeout)
+
+def store_error(path, exc):
+    print(f"Warning: result store {path} not updated: {exc}", file=sys.stderr, flush=True)
+
+
+def parse_ts(text):
+    """Epoch seconds from a now_ts() stamp, an ISO date/time, HH:MM (today) or 90m/6h/2d ago."""
+    text = text.strip()
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text[-1:] in units and text[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(text[:-1]) * units[text[-1]]
+    for fmt in ("%Y%m%d-%H%M%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    for fmt in ("%H:%M:%S", "%H:%M"):
+        try:
+            clock = time.strptime(text, fmt)
+        except ValueError:
+            continue
+        today = time.localtime()
+        return time.mktime((today.tm_year, today.tm_mon, today.tm_mday,
+                            clock.tm_hour, clock.tm_min, clock.tm_sec, 0, 0, -1))
+    raise ValueError(f"unrecognised time: {text}")
+
+
+def summarize_service(rows, until):
+    """Uptime, latency percentiles and outage windows from (ts, ok, duration_ms) rows in time order."""
+    latencies = sorted(duration for _, ok, duration in rows if ok)
+    outages = []
+    current = None
+    for ts, ok, _ in rows:
+        if not ok:
+            if current is None:
+                current = {"start": ts, "end": None, "failed_checks": 0}
+                outages.append(current)
+            current["failed_checks"] += 1
+        elif current is not None:
+            current["end"] = ts
+            current = None
+    for outage in outages:
+        # An outage still open at the end of the range is counted up to `until`.
+        outage["seconds"] = round((outage["end"] or until) - outage["start"], 1)
+    ok_count = sum(1 for _, ok, _ in rows if ok)
+    latency = {f"p{int(q * 100)}": percentile(latencies, q) for q in METRICS_QUANTILES}
+    latency["max"] = latencies[-1] if latencies else 0
+    return {
+        "checks": len(rows),
+        "ok": ok_count,
+        "uptime_pct": round(100.0 * ok_count / len(rows), 2) if rows else None,
+        "latency_ms": latency,
+        "outages": outages,
+    }
+
+
+def query_store(db, since, until, services=None):
+    sql = "SELECT service, ts, ok, duration_ms FROM results WHERE ts >= ? AND ts < ?"
+    params = [since, until]
+    if services:
+        sql += f" AND service IN ({','.join('?' * len(services))})"
+        params += services
+    grouped = {}
+    for service, ts, ok, duration in db.execute(sql + " ORDER BY service, ts", params):
+        grouped.setdefault(service, []).append((ts, ok, duration))
+    until = min(until, time.time())
+    return {name: summarize_service(rows, until) for name, rows in grouped.items()}
+
+
+def format_clock(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+
+def import_results(db, paths):
+    """Load existing run JSON files and daemon JSON lines into the store."""
+    total = 0
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            if path.endswith(".jsonl"):
+                results = [json.loads(line) for line in f if line.strip()]
+            else:
+                data = json.load(f)
+                results = [dict(r, timestamp=data["timestamp"]) for r in data.get("results", [])]
+        for result in results:
+            result["ts"] = parse_ts(result["timestamp"])
+        count = store_results(db, results)
+        print(f"{path}: {count} results")
+        total += count
+    return total
+
+
+def store_main(argv):
+    """`query` and `import` subcommands over the result store."""
+    parser = argparse.ArgumentParser(
+        prog="service_check.py query|import",
+        description="Uptime, latency percentiles and outage windows from the result store",
+    )
+    parser.add_argument("command", choices=("query", "import"))
+    parser.add_argument("paths", nargs="*", help="Run JSON / daemon JSONL files (import)")
+    parser.add_argument("--store", default=DEFAULT_STORE, help=f"Result store (default: {DEFAULT_STORE})")
+    parser.add_argument("--service", action="append", help="Service name (repeatable; default: all)")
+    parser.add_argument("--since", default="24h", help="Start: 14:00, 2026-03-07 14:00, 20260307-140000 or 6h (ago)")
+    parser.add_argument("--until", default=None, help="End, same formats (default: now)")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_intermixed_args(argv)
+
+    if args.command == "import":
+        db = open_store(args.store)
+        total = import_results(db, args.paths)
+        print(f"Imported {total} results into {args.store}")
+        return 0
+
+    if not os.path.exists(args.store):
+        print(f"Result store not found: {args.store}")
+        return 1
+    try:
+        since = parse_ts(args.since)
+        until = parse_ts(args.until) if args.until else time.time()
+    except ValueError as exc:
+        print(str(exc))
+        return 1
+    summary = query_store(open_store(args.store), since, until, args.service)
+    if args.json:
+        print(json.dumps({"since": since, "until": until, "services": summary}, indent=2))
+        return 0
+    print(f"{format_clock(since)} .. {format_clock(until)}")
+    if not summary:
+        print("no results in range")
+    for name, stats in sorted(summary.items()):
+        latency = stats["latency_ms"]
+        line = f"{name}: uptime {stats['uptime_pct']:.2f}% ({stats['ok']}/{stats['checks']})"
+        if stats["ok"]:
+            line += " " + " ".join(f"{key}={value}ms" for key, value in latency.items())
+        print(line)
+        for outage in stats["outages"]:
+            end = format_clock(outage["end"]) if outage["end"] else "ongoing"
+            print(
+                f"  outage {format_clock(outage['start'])} -> {end} "
+                f"({outage['seconds']:.0f}s, {outage['failed_checks']} failed checks)"
+            )
+    return 0
+
+
+def run_check(service, timeout):
+    func, _ = CHECKERS.get(service.get("type", "tcp").lower(), CHECKERS["tcp"])
+    return func(service, timeout)
+
+
+def service_timeout(service, default):
+    return float(service.get("timeout_seconds", default))
+
+
+def timed_check(service, timeout):
+    """Run one check; returns (ok, duration, detail, timings)."""
+    start = time.perf_counter()
+    timings = None
+    try:
+        outcome = run_check(service, timeout)
+        ok, detail = outcome[0], outcome[1]
+        if len(outcome) > 2:
+            timings = outcome[2]
+    except Exception as exc:
+        ok, detail = False, f"check error: {exc}"
+    return ok, time.perf_counter() - start, detail, timings
+
+
+def load_health(path):
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError) as exc:
+        print(f"Ignoring unreadable health state {path}: {exc}")
+        return
+    with HEALTH_LOCK:
+        HEALTH.update(state)
+
+
+def save_health(path):
+    if not path:
+        return
+    ensure_dir(os.path.dirname(path) or ".")
+    with HEALTH_LOCK:
+        data = json.dumps(HEALTH, indent=2, sort_keys=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def service_health(name):
+    with HEALTH_LOCK:
+        state = HEALTH.get(name)
+        if state is None:
+            state = {"srtt": None, "rttvar": 0.0, "samples": 0, "failures": 0}
+            HEALTH[name] = state
+        return state
+
+
+def adaptive_timeout(state, base_timeout):
+    """Deadline from smoothed check duration: srtt + 4 * rttvar as for TCP RTO,
+    but never under twice the srtt or ADAPTIVE_MIN_FACTOR * timeout_seconds.
+
+    Services with too little history, or that are currently failing, keep
+    timeout_seconds so a slow recovery is not mistaken for an outage.
+    """
+    if state["failures"] or state["samples"] < ADAPTIVE_MIN_SAMPLES or state["srtt"] is None:
+        return base_timeout
+    rto = max(2 * state["srtt"], state["srtt"] + 4 * state["rttvar"])
+    floor = max(ADAPTIVE_MIN_TIMEOUT, base_timeout * ADAPTIVE_MIN_FACTOR)
+    return min(base_timeout * ADAPTIVE_MAX_FACTOR, max(floor, rto))
+
+
+def observe_rtt(state, duration):
+    if state["srtt"] is None:
+        state["srtt"], state["rttvar"] = duration, duration / 2
+    else:
+        state["rttvar"] = 0.75 * state["rttvar"] + 0.25 * abs(state["srtt"] - duration)
+        state["srtt"] = 0.875 * state["srtt"] + 0.125 * duration
+    state["samples"] += 1
+
+
+def probe_check(service, timeout):
+    """Cheap reachability probe used while a service's circuit is open."""
+    service_type = service.get("type", "tcp").lower()
+    if service_type == "dns":
+        first = dns_queries(service)[0]
+        probe = dict(service, queries=[{"type": DNS_TYPE_NAMES[first[1]], "name": first[0]}])
+        return timed_check(probe, timeout)
+    port = service.get("port", DEFAULT_PORTS.get(service_type, 0))
+    return timed_check(dict(service, type="tcp", port=port), timeout)
+
+
+def guarded_check(service, timeout, adaptive=True):
+    """timed_check with an adaptive deadline and a circuit breaker.
+
+    After BREAKER_THRESHOLD consecutive failures the circuit opens: each sweep
+    first runs a short TCP probe, and a failed probe is reported without
+    waiting out the full check. A passing probe runs the full check at once,
+    so a recovery shows up on the first sweep after it happens.
+    Returns (ok, duration, detail, timings, extra) where extra is recorded with
+    the result.
+    """
+    state = service_health(service.get("name", "unnamed"))
+    breaker = adaptive and service.get("circuit_breaker", True)
+    extra = {}
+    if breaker and state["failures"] >= BREAKER_THRESHOLD:
+        ok, duration, detail, timings = probe_check(service, min(PROBE_TIMEOUT, timeout))
+        if not ok:
+            state["failures"] += 1
+            detail = f"circuit open after {state['failures'] - 1} failures, probe failed ({detail})"
+            return False, duration, detail, timings, {"circuit": "open"}
+        extra["circuit"] = "half-open"
+
+    deadline = adaptive_timeout(state, timeout) if adaptive else timeout
+    ok, duration, detail, timings = timed_check(service, deadline)
+    extra["timeout_s"] = round(deadline, 3)
+    if ok:
+        observe_rtt(state, duration)
+        state["failures"] = 0
+    else:
+        state["failures"] += 1
+        if breaker and state["failures"] >= BREAKER_THRESHOLD:
+            extra["circuit"] = "open"
+    return ok, duration, detail, timings, extra
+
+
+def host_key(service):
+    host = service.get("host")
+    if not host and service.get("url"):
+        host = import_module("urllib.parse").urlsplit(service["url"]).hostname
+    return host or service.get("name", "unnamed")
+
+
+class Dispatcher:
+    """Thread pool front end with a global and a per-host limit on checks in flight.
+
+    Checks for a host at its limit wait in a per-host queue; hosts take turns as
+    slots free up, so one slow host cannot occupy every worker.
+    """
+
+    def __init__(self, concurrency, per_host=DEFAULT_PER_HOST):
+        from concurrent.futures import Future, ThreadPoolExecutor
+
+        self.concurrency = max(1, int(concurrency))
+        self.per_host = max(1, int(per_host))
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.new_future = Future
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.hosts = {}  # host -> checks in flight
+        self.waiting = {}  # host -> deque of (future, fn, args), in turn order
+        self.closed = False
+
+    def submit(self, host, fn, *args):
+        future = self.new_future()
+        with self.lock:
+            self.waiting.setdefault(host, deque()).append((future, fn, args))
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        launch = []
+        with self.lock:
+            for host in list(self.waiting):
+                if self.closed or self.inflight >= self.concurrency:
+                    break
+                queue = self.waiting.pop(host)
+                while queue and self.inflight < self.concurrency and self.hosts.get(host, 0) < self.per_host:
+                    launch.append((host,) + queue.popleft())
+                    self.inflight += 1
+                    self.hosts[host] = self.hosts.get(host, 0) + 1
+                if queue:
+                    self.waiting[host] = queue  # back of the line
+        for host, future, fn, args in launch:
+            inner = self.pool.submit(fn, *args)
+            inner.add_done_callback(lambda f, h=host, out=future: self.done(h, out, f))
+
+    def done(self, host, future, inner):
+        with self.lock:
+            self.inflight -= 1
+            self.hosts[host] -= 1
+            if not self.hosts[host]:
+                del self.hosts[host]
+        self.dispatch()
+        if inner.cancelled():
+            future.cancel()
+        elif inner.exception() is not None:
+            future.set_exception(inner.exception())
         else:
-            ok, detail = check_tcp(service, timeout)
+            future.set_result(inner.result())
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.waiting.clear()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def run_checks(
+    config,
+    output_path,
+    concurrency=DEFAULT_CONCURRENCY,
+    metrics_file=None,
+    state_file=None,
+    adaptive=True,
+    store=None,
+    per_host=DEFAULT_PER_HOST,
+):
+    started = time.time()
+    timeout = int(config.get("timeout_seconds", DEFAULT_TIMEOUT))
+    services = config.get("services", [])
+    results = []
+    load_health(state_file)
+    load_checkers(services)
+
+    # Queue every enabled check up front, then collect in config order so the
+    # printed lines and JSON results keep the same ordering as before.
+    workers = max(1, min(int(concurrency), len(services) or 1))
+    dispatcher = Dispatcher(workers, per_host)
+    try:
+        pending = []
+        for service in services:
+            if service.get("enabled", True):
+                pending.append(dispatcher.submit(
+                    host_key(service),
+                    guarded_check,
+                    service,
+                    service_timeout(service, timeout),
+                    adaptive,
+                ))
+            else:
+                pending.append(None)
+
+        for service, future in zip(services, pending):
+            name = service.get("name", "unnamed")
+            service_type = service.get("type", "tcp").lower()
 
-        duration = time.time() - start
-        record_result(results, name, service_type, ok, duration, detail)
-        status = "OK" if ok else "FAIL"
-        print(f"{status} {name} ({service_type}): {detail}")
+            if future is None:
+                record_result(
+                    results,
+                    name,
+                    service_type,
+                    True,
+                    0,
+                    "skipped (disabled)",
+                    skipped=True,
+                )
+                print(f"SKIP {name} ({service_type}): disabled")
+                continue
+
+            ok, duration, detail, timings, extra = future.result()
+            record_result(
+                results, name, service_type, ok, duration, detail, timings=timings,
+                extra=extra,
+            )
+            status = "OK" if ok else "FAIL"
+            print(f"{status} {name} ({service_type}): {detail}")
+    finally:
+        dispatcher.close()
 
     ensure_dir(os.path.dirname(output_path))
     with open(output_path, "w", encoding="utf-8") as f:
         json.dump({"timestamp": now_ts(), "results": results}, f, indent=2)
+    save_health(state_file)
+    if store:
+        try:
+            store_results(open_store(store), results, started)
+        except (OSError, import_module("sqlite3").Error) as exc:
+            store_error(store, exc)
+
+    if metrics_file:
+        load_metrics(metrics_file)
+        for result in results:
+            observe_result(result)
+        write_metrics_file(metrics_file)
 
     any_fail = any((not r["ok"]) and (not r.get("skipped")) for r in results)
     return 2 if any_fail else 0
 
 
+def config_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def build_schedule(config, interval, previous=None):
+    """Map service name -> schedule entry, keeping due times across reloads."""
+    previous = previous or {}
+    schedule = {}
+    added = {}  # host -> names of new entries
+    for service in config.get("services", []):
+        if not service.get("enabled", True):
+            continue
+        name = service.get("name", "unnamed")
+        period = float(service.get("interval_seconds", interval))
+        entry = previous.get(name)
+        if entry is None:
+            entry = {"running": False}
+            added.setdefault(host_key(service), []).append(name)
+        # Entries are updated in place so in-flight checks still clear their own flag.
+        entry["service"] = service
+        entry["period"] = max(period, 1.0)
+        schedule[name] = entry
+
+    # Spread first runs evenly across one period, taking hosts in turn so
+    # neighbouring slots go to different hosts.
+    order = [name for group in itertools.zip_longest(*added.values()) for name in group if name is not None]
+    now = time.monotonic()
+    for slot, name in enumerate(order):
+        entry = schedule[name]
+        entry["base"] = now + entry["period"] * slot / len(order)
+    return schedule
+
+
+def append_line(output_path, line, max_bytes):
+    if max_bytes and os.path.exists(output_path) and os.path.getsize(output_path) >= max_bytes:
+        os.replace(output_path, output_path + ".1")
+    with open(output_path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def handle_term(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_daemon(
+    config_path,
+    output_path,
+    interval,
+    concurrency=DEFAULT_CONCURRENCY,
+    jitter=DEFAULT_JITTER,
+    max_bytes=DEFAULT_MAX_BYTES,
+    metrics_file=None,
+    metrics_port=None,
+    state_file=None,
+    adaptive=True,
+    store=None,
+    config_cache=CONFIG_CACHE_DIR,
+    per_host=DEFAULT_PER_HOST,
+):
+    """Check each enabled service on its own period until interrupted.
+
+    Due times advance from a fixed base (base += period) so checks do not drift;
+    jitter only delays the individual firing. Firings are kept in a heap, so a
+    wake-up costs O(log n) however many services are configured, and checks go
+    through a Dispatcher that enforces the global and per-host limits. Results
+    are appended as JSON lines.
+    """
+    ensure_dir(os.path.dirname(output_path) or ".")
+    config = load_config(config_path, config_cache)
+    load_checkers(config.get("services", []))
+    mtime = config_mtime(config_path)
+    schedule = build_schedule(config, interval)
+    lock = threading.Lock()
+    load_health(state_file)
+    if metrics_file:
+        load_metrics(metrics_file)
+    db = None
+    if store:
+        try:
+            db = open_store(store)
+        except (OSError, import_module("sqlite3").Error) as exc:
+            store_error(store, exc)
+    flushed = [time.monotonic()]
+
+    def flush():
+        if metrics_file:
+            write_metrics_file(metrics_file)
+        save_health(state_file)
+        flushed[0] = time.monotonic()
+
+    def finish(entry, service_type, future):
+        if future.cancelled():
+            entry["running"] = False
+            return
+        ok, duration, detail, timings, extra = future.result()
+        results = []
+        record_result(
+            results,
+            entry["service"].get("name", "unnamed"),
+            service_type,
+            ok,
+            duration,
+            detail,
+            timings=timings,
+            extra=extra,
+        )
+        results[0]["timestamp"] = now_ts()
+        observe_result(results[0])
+        with lock:
+            entry["running"] = False
+            append_line(output_path, json.dumps(results[0]), max_bytes)
+            if db is not None:
+                try:
+                    store_results(db, results)
+                except (OSError, import_module("sqlite3").Error) as exc:
+                    store_error(store, exc)
+            if time.monotonic() - flushed[0] >= FLUSH_INTERVAL:
+                flush()
+            status = "OK" if ok else "FAIL"
+            print(f"{status} {results[0]['name']} ({service_type}): {detail}", flush=True)
+
+    def next_firing(name, entry):
+        entry["due"] = entry["base"] + random.uniform(0, jitter * entry["period"])
+        return (entry["due"], name)
+
+    signal.signal(signal.SIGTERM, handle_term)
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    print(f"Daemon: {len(schedule)} services, appending to {output_path}", flush=True)
+    dispatcher = Dispatcher(concurrency, per_host)
+    heap = [next_firing(name, entry) for name, entry in schedule.items()]
+    heapq.heapify(heap)
+    try:
+        while True:
+            current = config_mtime(config_path)
+            if current is not None and current != mtime:
+                try:
+                    config = load_config(config_path, config_cache)
+                    load_checkers(config.get("services", []))
+                except (OSError, ValueError) as exc:
+                    print(f"Config reload failed, keeping previous: {exc}", flush=True)
+                else:
+                    with lock:
+                        schedule = build_schedule(config, interval, schedule)
+                    heap = [
+                        (entry["due"], name) if "due" in entry else next_firing(name, entry)
+                        for name, entry in schedule.items()
+                    ]
+                    heapq.heapify(heap)
+                    print(f"Config reloaded: {len(schedule)} services", flush=True)
+                mtime = current
+
+            timeout = int(config.get("timeout_seconds", DEFAULT_TIMEOUT))
+            now = time.monotonic()
+            while heap and heap[0][0] <= now:
+                due, name = heapq.heappop(heap)
+                entry = schedule.get(name)
+                if entry is None or entry.get("due") != due:
+                    continue
+                with lock:
+                    busy = entry["running"]
+                    entry["running"] = True
+                # A check still queued or running from its last period is not fired again.
+                if not busy:
+                    service = entry["service"]
+                    future = dispatcher.submit(
+                        host_key(service),
+                        guarded_check,
+                        service,
+                        service_timeout(service, timeout),
+                        adaptive,
+                    )
+                    future.add_done_callback(
+                        lambda f, e=entry, t=service["type"]: finish(e, t, f)
+                    )
+                # Skip missed periods instead of firing a burst to catch up.
+                while entry["base"] <= now:
+                    entry["base"] += entry["period"]
+                heapq.heappush(heap, next_firing(name, entry))
+            next_wake = min(heap[0][0], now + 1.0) if heap else now + 1.0
+            time.sleep(max(0.0, next_wake - time.monotonic()))
+    except KeyboardInterrupt:
+        print("Daemon stopped.", flush=True)
+        dispatcher.close()
+        with lock:
+            flush()
+    return 0
+
+
+def list_services(config, cache_path=None):
+    """Print the service list; also saved to cache_path so shell wrappers can reuse it."""
+    services = config.get("services", [])
+    lines = [f"services: {len(services)}"]
+    for service in services:
+        lines.append(f"- {service.get('name', 'unnamed')} ({service.get('type', 'tcp')}) "
+                     f"enabled={service.get('enabled', True)}")
+    text = "\n".join(lines) + "\n"
+    sys.stdout.write(text)
+    if cache_path:
+        try:
+            ensure_dir(os.path.dirname(cache_path))
+            with open(cache_path, "w", encoding="utf-8") as f:
+                f.write(text)
+        except OSError:
+            pass
+
+
+def default_store(args, output_path):
+    """--store, or results.db beside the output so a run only writes where its output goes."""
+    if args.no_store:
+        return None
+    return args.store or os.path.join(os.path.dirname(output_path) or ".", "results.db")
+
+
 def main():
+    STARTUP["main"] = time.process_time()
+    if sys.argv[1:2] in (["query"], ["import"]):
+        return store_main(sys.argv[1:])
     parser = argparse.ArgumentParser(description="MACCDC safe service checks")
     parser.add_argument(
         "--config",
@@ -285,21 +1721,142 @@ def main():
     parser.add_argument(
         "--output",
         default=None,
-        help="Output JSON path (default: artifacts/service_checks/<timestamp>.json)",
+        help=(
+            "Output JSON path (default: artifacts/service_checks/<timestamp>.json, "
+            "or artifacts/service_checks/daemon.jsonl with --daemon)"
+        ),
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Max checks to run in parallel (default: {DEFAULT_CONCURRENCY}, 1 = sequential)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Stay resident and check each service on its own period",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help=f"Default seconds between checks in daemon mode (default: {DEFAULT_INTERVAL})",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=DEFAULT_JITTER,
+        help=f"Random delay per check as a fraction of its period (default: {DEFAULT_JITTER})",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write Prometheus text metrics (p50/p95/p99 per service and phase) to this path",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics on 127.0.0.1:<port>/metrics (daemon mode)",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=None,
+        help=(
+            "Keep per-service RTT history and circuit breaker state in this file between runs "
+            f"(default: {DEFAULT_STATE_FILE} with --daemon; one-shot runs start fresh)"
+        ),
+    )
+    parser.add_argument(
+        "--no-adaptive",
+        action="store_true",
+        help="Use timeout_seconds as-is for every check and disable the circuit breaker",
+    )
+    parser.add_argument(
+        "--store",
+        help="Also append results to this SQLite store (default: results.db next to the output)",
+    )
+    parser.add_argument(
+        "--no-store",
+        action="store_true",
+        help="Do not append results to the SQLite store",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=DEFAULT_PER_HOST,
+        help=f"Max checks in flight against one host (default: {DEFAULT_PER_HOST})",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the configured services and exit",
+    )
+    parser.add_argument(
+        "--no-config-cache",
+        action="store_true",
+        help=f"Always re-parse the config instead of using the cache in {CONFIG_CACHE_DIR}",
+    )
+    parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        help="Print start-up, config load and lazy import timings to stderr on exit",
     )
     args = parser.parse_args()
+    if args.startup_report:
+        atexit.register(startup_report)
+    config_cache = None if args.no_config_cache else CONFIG_CACHE_DIR
+    adaptive = not args.no_adaptive
 
     if not os.path.exists(args.config):
         print(f"Config not found: {args.config}")
         return 1
 
-    config = load_config(args.config)
+    try:
+        config = load_config(args.config, config_cache)
+    except ValueError as exc:
+        print(f"Config error: {exc}")
+        return 1
+
+    if args.list:
+        list_services(config, config_cache and config_cache_path(args.config, config_cache, ".list"))
+        return 0
+
+    if args.daemon:
+        output_path = args.output or os.path.join("artifacts", "service_checks", "daemon.jsonl")
+        store = default_store(args, output_path)
+        return run_daemon(
+            args.config,
+            output_path,
+            args.interval,
+            args.concurrency,
+            args.jitter,
+            metrics_file=args.metrics_file,
+            metrics_port=args.metrics_port,
+            state_file=args.state_file or DEFAULT_STATE_FILE,
+            adaptive=adaptive,
+            store=store,
+            config_cache=config_cache,
+            per_host=args.per_host,
+        )
+
     if args.output:
         output_path = args.output
     else:
         output_path = os.path.join("artifacts", "service_checks", f"{now_ts()}.json")
+    store = default_store(args, output_path)
 
-    return run_checks(config, output_path)
+    return run_checks(
+        config,
+        output_path,
+        args.concurrency,
+        args.metrics_file,
+        args.state_file,
+        adaptive,
+        store,
+        args.per_host,
+    )
 
 
 if __name__ == "__main__":